@@ -0,0 +1,243 @@
+import os
+import json
+import glob
+import argparse
+import logging
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import nim
+
+# Streamlit logs a "no runtime" warning for every cached call when run headless
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", str(os.cpu_count() or 2)))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "25"))
+
+def load_account(path):
+    return nim.PositionLoader.load(path)
+
+def account_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def load_accounts(path, name=None):
+    # Multi-account exports are split into one report per account number
+    portfolio_df = load_account(path)
+    name = name or account_name(path)
+    if "Account Number" not in portfolio_df or portfolio_df["Account Number"].nunique() <= 1:
+        return {name: portfolio_df}
+    accounts = {}
+    for number, group in portfolio_df.groupby("Account Number", sort=False):
+        group = group.reset_index(drop=True)
+        # Each account keeps its own cash; the file-wide total would misstate its cash share
+        group.attrs = {"cash_value": portfolio_df.attrs.get("account_cash", {}).get(number, 0.0)}
+        accounts[f"{name}-{number}"] = group
+    return accounts
+
+def init_worker(llm_concurrency, min_interval):
+    nim.llm_limiter = nim.LLMLimiter(max_concurrency=llm_concurrency, min_interval=min_interval)
+    # Worker spans are sent back with the results and exported once by the parent
+    nim.tracer.export_path = None
+
+def analyze_tickers(tickers):
+    results = {}
+    for ticker, analysis, metrics in nim.iter_portfolio_analysis(nim.get_analyzer(), tickers):
+        results[ticker] = {"analysis": analysis, "recommendation": nim.recommendation(analysis), "metrics": metrics}
+    return results, nim.tracer.drain()
+
+def analyze_unique_tickers(tickers, workers=BATCH_MAX_WORKERS, chunk_size=BATCH_CHUNK_SIZE, llm_concurrency=nim.LLM_MAX_CONCURRENCY):
+    # Prices land in the shared on-disk store once, so worker processes read them without refetching
+    nim.DataFetcher.prefetch_stock_data(tickers + [nim.RISK_BENCHMARK])
+    chunks = [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+    results = {}
+    if not chunks:
+        return results
+    # llm_concurrency and LLM_MIN_INTERVAL are limits for the whole batch, so each worker process gets its share;
+    # there are never more workers than LLM slots
+    workers = max(1, min(workers, len(chunks), llm_concurrency))
+    initargs = (max(1, llm_concurrency // workers), nim.LLM_MIN_INTERVAL * workers)
+    # The API calls this from threadpool threads; a forked child could inherit a lock another thread holds
+    # (logging, SQLite, HTTP pools), so workers start from a fresh interpreter
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=initargs) as pool:
+        for chunk_results, spans in pool.map(analyze_tickers, chunks):
+            results.update(chunk_results)
+            nim.tracer.ingest(spans)
+    return results
+
+def clean(value):
+    if isinstance(value, dict):
+        return {key: clean(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [clean(item) for item in value]
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+def account_report(name, portfolio_df, ticker_results):
+    risk_report = nim.get_portfolio_risk(portfolio_df)
+    holdings = []
+    for symbol in dict.fromkeys(portfolio_df["Symbol"]):
+        holding = {"symbol": symbol, **ticker_results.get(symbol, {"analysis": None, "recommendation": None, "metrics": {}})}
+        if risk_report is not None and symbol in risk_report["assets"].index:
+            holding["risk"] = risk_report["assets"].loc[symbol].to_dict()
+        holdings.append(holding)
+    return clean({
+        "account": name,
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "holdings": holdings,
+        "portfolio_risk": risk_report["portfolio"] if risk_report is not None else None,
+    })
+
+def run_batch(accounts, workers=BATCH_MAX_WORKERS, chunk_size=BATCH_CHUNK_SIZE, llm_concurrency=nim.LLM_MAX_CONCURRENCY):
+    # Holdings shared across accounts are analyzed once
+    tickers = list(dict.fromkeys(symbol for portfolio_df in accounts.values() for symbol in portfolio_df["Symbol"]))
+    ticker_results = analyze_unique_tickers(tickers, workers, chunk_size, llm_concurrency)
+    return [account_report(name, portfolio_df, ticker_results) for name, portfolio_df in accounts.items()]
+
+def simulation_report(name, result, top=nim.SIMULATION_TOP):
+    # Named scenarios and the best random mixes, each with the weights it held
+    table = nim.simulation_table(result, top)
+    scenarios = []
+    for scenario, row in table.to_dict("index").items():
+        weights = result["weights"].loc[scenario]
+        scenarios.append({"name": scenario, **row, "weights": weights[weights > 0].to_dict()})
+    return clean({
+        "account": name,
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "start": result["dates"][0].isoformat(),
+        "end": result["dates"][-1].isoformat(),
+        "scenario_count": len(result["summary"]),
+        "scenarios": scenarios,
+    })
+
+def run_simulations(accounts, rebalance="quarterly", stop_loss=0.0, cost_bps=nim.SIMULATION_COST_BPS,
+                    random_scenarios=nim.SIMULATION_RANDOM_SCENARIOS, custom=(), with_recommendations=False):
+    recommendations = None
+    if with_recommendations:
+        tickers = list(dict.fromkeys(symbol for portfolio_df in accounts.values() for symbol in portfolio_df["Symbol"]))
+        recommendations = {ticker: result["recommendation"] for ticker, result in analyze_unique_tickers(tickers).items()}
+    reports = []
+    for name, portfolio_df in accounts.items():
+        result = nim.simulate_portfolio(portfolio_df, rebalance, stop_loss, cost_bps, random_scenarios, custom, recommendations)
+        if result is not None:
+            reports.append(simulation_report(name, result))
+    return reports
+
+def write_simulations(reports, out_dir, output_format="json"):
+    os.makedirs(out_dir, exist_ok=True)
+    if output_format == "json":
+        for report in reports:
+            with open(os.path.join(out_dir, f"{report['account']}.simulation.json"), "w") as f:
+                json.dump(report, f, indent=2)
+        return
+    rows = [{"account": report["account"], "generated_at": report["generated_at"], **{key: value for key, value in scenario.items() if key != "weights"},
+             "weights": json.dumps(scenario["weights"])} for report in reports for scenario in report["scenarios"]]
+    pd.DataFrame(rows).to_parquet(os.path.join(out_dir, "simulation.parquet"), index=False)
+
+def write_results(reports, out_dir, output_format="json"):
+    os.makedirs(out_dir, exist_ok=True)
+    if output_format == "json":
+        for report in reports:
+            with open(os.path.join(out_dir, f"{report['account']}.json"), "w") as f:
+                json.dump(report, f, indent=2)
+        return
+    rows = []
+    for report in reports:
+        for holding in report["holdings"]:
+            row = {"account": report["account"], "generated_at": report["generated_at"], "symbol": holding["symbol"],
+                   "recommendation": holding["recommendation"], "analysis": holding["analysis"]}
+            row.update({f"risk_{key.lower().replace(' ', '_')}": value for key, value in holding.get("risk", {}).items()})
+            row.update({f"llm_{key}": value for key, value in holding["metrics"].items() if key != "call"})
+            rows.append(row)
+    pd.DataFrame(rows).to_parquet(os.path.join(out_dir, "analysis.parquet"), index=False)
+
+def create_app():
+    from fastapi import FastAPI, Form, UploadFile
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import PlainTextResponse
+
+    app = FastAPI(title="Personal Financial Stock Analyzer")
+
+    @app.post("/analyze")
+    async def analyze(files: list[UploadFile]):
+        accounts = {}
+        for file in files:
+            accounts.update(load_accounts(file.file, account_name(file.filename)))
+        return await run_in_threadpool(run_batch, accounts)
+
+    @app.post("/simulate")
+    async def simulate(files: list[UploadFile], rebalance: str = Form("quarterly"), stop_loss: float = Form(0.0),
+                       cost_bps: float = Form(nim.SIMULATION_COST_BPS), random_scenarios: int = Form(nim.SIMULATION_RANDOM_SCENARIOS),
+                       scenarios: str = Form("[]"), with_recommendations: bool = Form(False)):
+        accounts = {}
+        for file in files:
+            accounts.update(load_accounts(file.file, account_name(file.filename)))
+        return await run_in_threadpool(run_simulations, accounts, rebalance, stop_loss, cost_bps, random_scenarios,
+                                       json.loads(scenarios), with_recommendations)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return nim.tracer.to_prometheus()
+
+    @app.get("/traces", response_class=PlainTextResponse)
+    def traces():
+        return PlainTextResponse(nim.tracer.to_jsonl(), media_type="application/x-ndjson")
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze brokerage position CSVs without the Streamlit UI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze_parser = subparsers.add_parser("analyze", help="analyze one or more position CSVs")
+    analyze_parser.add_argument("paths", nargs="+", help="CSV files or glob patterns, e.g. 'Portfolio_Positions_*.csv'")
+    analyze_parser.add_argument("--out", default="results", help="output directory")
+    analyze_parser.add_argument("--format", choices=["json", "parquet"], default="json")
+    analyze_parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="worker processes")
+    analyze_parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_SIZE, help="tickers per worker task")
+    analyze_parser.add_argument("--llm-concurrency", type=int, default=nim.LLM_MAX_CONCURRENCY, help="simultaneous LLM requests across all workers")
+
+    simulate_parser = subparsers.add_parser("simulate", help="replay holdings, alternative weights and sell rules over the price history")
+    simulate_parser.add_argument("paths", nargs="+", help="CSV files or glob patterns")
+    simulate_parser.add_argument("--out", default="results", help="output directory")
+    simulate_parser.add_argument("--format", choices=["json", "parquet"], default="json")
+    simulate_parser.add_argument("--rebalance", choices=list(nim.REBALANCE_PERIODS), default="quarterly")
+    simulate_parser.add_argument("--stop-loss", type=float, default=0.0, help="trailing stop-loss as a fraction, e.g. 0.2; 0 disables it")
+    simulate_parser.add_argument("--cost-bps", type=float, default=nim.SIMULATION_COST_BPS, help="trading cost per unit of turnover in basis points")
+    simulate_parser.add_argument("--random", type=int, default=nim.SIMULATION_RANDOM_SCENARIOS, help="random weight scenarios")
+    simulate_parser.add_argument("--scenarios", help="JSON file with a list of {name, weights, sell, rebalance, stop_loss} scenarios")
+    simulate_parser.add_argument("--with-recommendations", action="store_true", help="analyze the holdings first and add a scenario that follows the sell recommendations")
+
+    serve_parser = subparsers.add_parser("serve", help="serve the analysis API with uvicorn")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        import uvicorn
+        uvicorn.run(create_app(), host=args.host, port=args.port)
+        return
+
+    paths = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    accounts = {}
+    for path in paths:
+        accounts.update(load_accounts(path))
+    if args.command == "simulate":
+        custom = []
+        if args.scenarios:
+            with open(args.scenarios) as f:
+                custom = json.load(f)
+        reports = run_simulations(accounts, args.rebalance, args.stop_loss, args.cost_bps, args.random, custom, args.with_recommendations)
+        write_simulations(reports, args.out, args.format)
+        print(f"Simulated {sum(report['scenario_count'] for report in reports)} scenarios for {len(reports)} accounts into {args.out}")
+        return
+    reports = run_batch(accounts, args.workers, args.chunk_size, args.llm_concurrency)
+    write_results(reports, args.out, args.format)
+    print(f"Analyzed {len(reports)} accounts ({sum(len(r['holdings']) for r in reports)} holdings) into {args.out}")
+
+if __name__ == "__main__":
+    main()
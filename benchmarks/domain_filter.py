@@ -0,0 +1,76 @@
+import os
+import sys
+import argparse
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Labeled chatbot questions. Most finance ones avoid FINANCE_KEYWORDS so they exercise the embedding margin.
+LABELED = [
+    ("Is Apple a good buy right now?", "finance"),
+    ("Should I pay off my mortgage early or put the money elsewhere?", "finance"),
+    ("How do I lower my tax bill this year?", "finance"),
+    ("What does a high debt-to-equity ratio mean?", "finance"),
+    ("Is it a good time to buy gold?", "finance"),
+    ("How much of my salary should I put aside each month?", "finance"),
+    ("Should I open a Roth account?", "finance"),
+    ("How big should my emergency fund be?", "finance"),
+    ("How do options work?", "finance"),
+    ("Explain what a short squeeze is.", "finance"),
+    ("Is Nvidia still growing its revenue?", "finance"),
+    ("What does the Fed meeting mean for my savings?", "finance"),
+    ("How do I build a good credit score?", "finance"),
+    ("What's the difference between a traditional and a Roth 401(k)?", "finance"),
+    ("Should I sell my Tesla position before the earnings call?", "finance"),
+    ("What is the capital of Australia?", "off_topic"),
+    ("How do I bake sourdough bread?", "off_topic"),
+    ("Who wrote Pride and Prejudice?", "off_topic"),
+    ("What's the best way to learn guitar?", "off_topic"),
+    ("How tall is Mount Everest?", "off_topic"),
+    ("Can you translate this sentence into French?", "off_topic"),
+    ("What causes migraines?", "off_topic"),
+    ("Recommend a fantasy novel.", "off_topic"),
+    ("How do I change a flat tire?", "off_topic"),
+    ("What time does the Super Bowl start?", "off_topic"),
+    ("Explain photosynthesis.", "off_topic"),
+    ("How do vaccines work?", "off_topic"),
+]
+
+def main():
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import nim
+
+    parser = argparse.ArgumentParser(description="Check the local domain filter's margins against labeled finance and off-topic questions.")
+    parser.add_argument("--accept-margin", type=float, default=nim.DOMAIN_ACCEPT_MARGIN)
+    parser.add_argument("--reject-margin", type=float, default=nim.DOMAIN_REJECT_MARGIN)
+    args = parser.parse_args()
+
+    if nim.get_embedding_model() is None:
+        print(f"Embedding model {nim.EMBEDDING_MODEL} is unavailable (EMBEDDING_CACHE_DIR={nim.EMBEDDING_CACHE_DIR}); "
+              "every question without a finance keyword would be sent to the guardrails check")
+        return 2
+    domain_filter = nim.DomainFilter(accept_margin=args.accept_margin, reject_margin=args.reject_margin)
+
+    results = []
+    for question, label in LABELED:
+        keyword = nim.DomainFilter.keyword_match(question)
+        margin = domain_filter.margin(question)
+        domain = "finance" if keyword else domain_filter.classify(question)
+        results.append((question, label, keyword, margin, domain))
+        print(f"{label:9} {'keyword' if keyword else 'margin':8} {margin:+.3f} -> {domain:10} {question}")
+
+    # Refusing a finance question is the costly error; an off-topic one let through is still refused by the LLM prompt
+    false_refusals = [r for r in results if r[1] == "finance" and r[4] == "off_topic"]
+    leaks = [r for r in results if r[1] == "off_topic" and r[4] == "finance"]
+    ambiguous = [r for r in results if r[4] == "ambiguous"]
+    finance_margins = [r[3] for r in results if r[1] == "finance" and not r[2]]
+    off_topic_margins = [r[3] for r in results if r[1] == "off_topic"]
+    print(f"\naccept {args.accept_margin:+.2f}, reject {args.reject_margin:+.2f}: {len(false_refusals)} finance questions refused, "
+          f"{len(leaks)} off-topic questions accepted, {len(ambiguous)} sent to guardrails")
+    print(f"embedding-path finance margins {min(finance_margins):+.3f}..{max(finance_margins):+.3f}, "
+          f"off-topic margins {min(off_topic_margins):+.3f}..{max(off_topic_margins):+.3f}")
+    return 1 if false_refusals else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
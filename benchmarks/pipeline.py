@@ -0,0 +1,166 @@
+import os
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import standins
+
+QUESTIONS = [
+    "What is the difference between an ETF and a mutual fund?",
+    "How should I rebalance a tech-heavy portfolio?",
+    "Which of my holdings has the largest gain?",
+    "What are the recent stocks in the news?",
+    "What is the coronavirus?",
+]
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples) * 1000
+    return {"count": len(values), "p50_ms": float(np.percentile(values, 50)), "p90_ms": float(np.percentile(values, 90)),
+            "p99_ms": float(np.percentile(values, 99)), "max_ms": float(values.max())}
+
+def synthetic_positions(size):
+    # Brokerage-format CSV so ingestion is exercised the same way as an upload
+    rng = np.random.default_rng(size)
+    weights = rng.dirichlet(np.ones(size)) * 100
+    rows = ["Symbol,Description,Quantity,Last Price,Last Price Change,Current Value,Today's Gain/Loss Dollar,Today's Gain/Loss Percent,"
+            "Total Gain/Loss Dollar,Total Gain/Loss Percent,Percent Of Account,Cost Basis Total,Average Cost Basis"]
+    for i in range(size):
+        price, quantity, cost = rng.uniform(10, 500), rng.uniform(1, 100), rng.uniform(10, 500)
+        value = price * quantity
+        rows.append(f'S{i:04d},SYNTHETIC HOLDING {i},{quantity:.3f},${price:.2f} ,${rng.normal(0, 2):.2f} ,"${value:,.2f} ",'
+                    f'${rng.normal(0, 20):.2f} ,{rng.normal(0, 2):.2f}%,"${value - cost * quantity:,.2f} ",{(price / cost - 1) * 100:.2f}%,'
+                    f'{weights[i]:.2f}%,"${cost * quantity:,.2f} ",${cost:.2f} ')
+    return "\n".join(rows) + "\n"
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def peak_memory(args):
+    # tracemalloc gives per-stage Python peaks but slows the run; otherwise report the process high-water mark
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_size(nim, st, size, args):
+    # Fresh stores per size so every run starts cold
+    nim.price_store = nim.PriceStore(tempfile.mkdtemp(prefix="bench-prices-"))
+    nim.shared_cache = nim.SharedCache(os.path.join(tempfile.mkdtemp(prefix="bench-shared-"), "shared_cache.sqlite"))
+    nim.news_fetcher.cache.clear()
+    st.session_state.clear()
+    nim.init_session_state()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    ingest_time, portfolio_df = measure(nim.PositionLoader.load, io.StringIO(synthetic_positions(size)))
+    st.session_state.portfolio_df = portfolio_df
+    analyze_time, _ = measure(nim.analyze_portfolio, portfolio_df)
+    analyze_peak = peak_memory(args)
+    tickers = portfolio_df["Symbol"].tolist()[:args.display_samples]
+    display_times = [measure(nim.display_analysis_results, ticker)[0] for ticker in tickers]
+    question_times = []
+    for i in range(args.questions):
+        st.session_state.pending_query = QUESTIONS[i % len(QUESTIONS)]
+        question_times.append(measure(nim.stream_pending_answer)[0])
+    interactive_peak = peak_memory(args)
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    metrics = [m for m in st.session_state.analysis_metrics.values() if "total_time" in m]
+    # Re-upload with one quantity changed: only that ticker's fingerprint differs
+    changed_df = portfolio_df.copy()
+    changed_df.loc[0, "Quantity"] += 1
+    reanalyze_time, _ = measure(nim.analyze_portfolio, changed_df)
+    reanalyzed = sum("total_time" in m for m in st.session_state.analysis_metrics.values())
+    return {
+        "positions": size,
+        "ingest_ms": ingest_time * 1000,
+        "analyze_portfolio": {
+            "wall_s": analyze_time,
+            "throughput_tickers_per_s": size / analyze_time,
+            "ticker_llm_total": percentiles([m["total_time"] for m in metrics]),
+            "ticker_time_to_first_token": percentiles([m["time_to_first_token"] for m in metrics]),
+            "completion_tokens_per_s": float(np.mean([m["tokens_per_second"] for m in metrics])) if metrics else 0.0,
+            "errors": sum(str(result).startswith("Error") for result in st.session_state.analysis_results.values()),
+            "peak_memory_mb": analyze_peak / 2 ** 20,
+        },
+        "reanalyze_one_changed": {"wall_s": reanalyze_time, "regenerated": reanalyzed},
+        "display_analysis_results": percentiles(display_times),
+        "answer_follow_up_question": percentiles(question_times),
+        "interactive_peak_memory_mb": interactive_peak / 2 ** 20,
+    }
+
+def print_report(report):
+    analyze = report["analyze_portfolio"]
+    print(f"\n== {report['positions']} positions ==")
+    print(f"ingest: {report['ingest_ms']:.1f} ms")
+    print(f"analyze_portfolio: {analyze['wall_s']:.2f} s wall, {analyze['throughput_tickers_per_s']:.1f} tickers/s, "
+          f"{analyze['completion_tokens_per_s']:.0f} completion tokens/s per stream, {analyze['errors']} errors, peak {analyze['peak_memory_mb']:.1f} MiB")
+    reanalyze = report["reanalyze_one_changed"]
+    print(f"re-upload with one changed position: {reanalyze['wall_s']:.2f} s wall, {reanalyze['regenerated']} analyses regenerated")
+    for name, stats in [("  per-ticker LLM total", analyze["ticker_llm_total"]), ("  per-ticker TTFT", analyze["ticker_time_to_first_token"]),
+                        ("display_analysis_results", report["display_analysis_results"]),
+                        ("answer_follow_up_question", report["answer_follow_up_question"])]:
+        if stats["count"]:
+            print(f"{name}: p50 {stats['p50_ms']:.1f} ms, p90 {stats['p90_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms (n={stats['count']})")
+    print(f"interactive peak memory: {report['interactive_peak_memory_mb']:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with local stand-ins for Yahoo Finance, Google and the LLM endpoint.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--tokens-per-second", type=float, default=400.0, help="fake LLM streaming rate")
+    parser.add_argument("--ttft", type=float, default=0.2, help="fake LLM time to first token in seconds")
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--yahoo-latency", type=float, default=0.05, help="seconds added to every stand-in Yahoo call")
+    parser.add_argument("--news-latency", type=float, default=0.05, help="seconds added to every stand-in search request")
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    parser.add_argument("--display-samples", type=int, default=20, help="tickers rendered with display_analysis_results")
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--trace-memory", action="store_true", help="measure per-stage peaks with tracemalloc (slower)")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+
+    _, news_url = standins.serve_news(latency=args.news_latency)
+    _, llm_url = standins.serve_fake_llm(args.tokens_per_second, args.ttft, args.completion_tokens)
+    # nim reads its endpoints and store locations at import time
+    os.environ.update({
+        "NEWS_SEARCH_URL": news_url,
+        "NVIDIA_BASE_URL": llm_url,
+        "NVIDIA_MODEL": "fake/llm",
+        "NVIDIA_API_KEY": "offline",
+        "PRICE_STORE_DIR": tempfile.mkdtemp(prefix="bench-prices-"),
+        "SEMANTIC_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-cache-"), "semantic_cache.sqlite"),
+        "SHARED_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-shared-"), "shared_cache.sqlite"),
+        "LLM_MIN_INTERVAL": "0",
+    })
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import streamlit as st
+    import nim
+    nim.yf = standins.fake_yfinance(args.yahoo_latency)
+    nim.llm_limiter = nim.LLMLimiter(max_concurrency=args.llm_concurrency, min_interval=0)
+
+    reports = []
+    for size in args.sizes:
+        reports.append(run_size(nim, st, size, args))
+        print_report(reports[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": reports}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import zlib
+import types
+import threading
+import http.server
+import numpy as np
+import pandas as pd
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+HISTORY_END = pd.Timestamp("2024-06-12")
+HISTORY_DAYS = 5 * 252
+
+def symbol_rng(symbol):
+    return np.random.default_rng(zlib.crc32(symbol.encode()))
+
+def synthetic_history(symbol, start=None):
+    # Deterministic business-day OHLCV series per symbol, shaped like Ticker.history(auto_adjust=True)
+    rng = symbol_rng(symbol)
+    index = pd.bdate_range(end=HISTORY_END, periods=HISTORY_DAYS, name="Date").tz_localize("America/New_York")
+    close = 20 + 200 * rng.random() * np.cumprod(1 + rng.normal(0.0004, 0.018, len(index)))
+    spread = close * rng.uniform(0.002, 0.02, len(index))
+    data = pd.DataFrame({
+        "Open": close + rng.normal(0, 0.5, len(index)) * spread,
+        "High": close + spread,
+        "Low": close - spread,
+        "Close": close,
+        "Volume": rng.integers(1_000_000, 50_000_000, len(index)),
+        "Dividends": 0.0,
+        "Stock Splits": 0.0,
+    }, index=index)
+    if start is not None:
+        data = data.loc[data.index.tz_localize(None) >= pd.Timestamp(start)]
+    return data
+
+def synthetic_statements(symbol):
+    rng = symbol_rng(symbol + ":fundamentals")
+    quarters = pd.date_range(end=HISTORY_END, periods=5, freq="QE")[::-1]
+    revenue = 1e9 * rng.uniform(1, 80) * np.cumprod(np.r_[1, rng.normal(0.98, 0.03, 4)])
+    income = pd.DataFrame({
+        "Total Revenue": revenue,
+        "Cost Of Revenue": revenue * rng.uniform(0.3, 0.6),
+        "Gross Profit": revenue * rng.uniform(0.4, 0.7),
+        "Operating Expense": revenue * rng.uniform(0.1, 0.3),
+        "Operating Income": revenue * rng.uniform(0.1, 0.4),
+        "Net Income": revenue * rng.uniform(0.05, 0.3),
+        "EBITDA": revenue * rng.uniform(0.2, 0.5),
+        "Diluted EPS": rng.uniform(0.1, 5, 5),
+        "Research And Development": revenue * rng.uniform(0.05, 0.2),
+    }, index=quarters).T
+    balance = pd.DataFrame({
+        "Total Debt": revenue * rng.uniform(0.2, 2),
+        "Cash And Cash Equivalents": revenue * rng.uniform(0.1, 1),
+        "Stockholders Equity": revenue * rng.uniform(1, 4),
+        "Total Assets": revenue * rng.uniform(3, 8),
+    }, index=quarters).T
+    return income, balance
+
+class FakeTicker:
+    def __init__(self, symbol, latency=0.0):
+        self.symbol = symbol
+        self.latency = latency
+
+    def history(self, period=None, start=None, **kwargs):
+        time.sleep(self.latency)
+        return synthetic_history(self.symbol, start)
+
+    @property
+    def quarterly_financials(self):
+        time.sleep(self.latency)
+        return synthetic_statements(self.symbol)[0]
+
+    @property
+    def quarterly_balance_sheet(self):
+        time.sleep(self.latency)
+        return synthetic_statements(self.symbol)[1]
+
+def fake_yfinance(latency=0.0):
+    # Drop-in for the parts of yfinance that nim.py uses: Ticker and a multi-ticker download
+    def download(tickers, start=None, group_by="column", **kwargs):
+        time.sleep(latency)
+        symbols = [tickers] if isinstance(tickers, str) else list(tickers)
+        frames = {symbol: synthetic_history(symbol, start).tz_localize(None) for symbol in symbols}
+        return pd.concat(frames, axis=1)
+
+    return types.SimpleNamespace(Ticker=lambda symbol: FakeTicker(symbol, latency), download=download)
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing pooled keep-alive connections is expected between runs
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+def start_server(handler_class):
+    server = QuietServer(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def serve_news(fixture="google_news.html", latency=0.0):
+    with open(os.path.join(FIXTURES_DIR, fixture), "rb") as f:
+        body = f.read()
+
+    class NewsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = start_server(NewsHandler)
+    return server, f"{url}/search"
+
+def serve_fake_llm(tokens_per_second=200.0, time_to_first_token=0.3, completion_tokens=150):
+    # OpenAI-compatible /v1/chat/completions that streams filler words at a fixed rate
+    words = "Overview The company reported steady revenue growth and healthy margins .".split()
+
+    class LLMHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = json.dumps({"object": "list", "data": [{"id": "fake/llm", "object": "model"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(time_to_first_token)
+            for i in range(completion_tokens):
+                word = "Hold the Stock" if i == completion_tokens - 1 else words[i % len(words)]
+                self.send_event({"choices": [{"index": 0, "delta": {"role": "assistant", "content": word + " "}, "finish_reason": None}]})
+                time.sleep(1.0 / tokens_per_second)
+            self.send_event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+
+        def send_event(self, payload):
+            self.send_chunk(f"data: {json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'model': 'fake/llm', **payload})}\n\n".encode())
+
+        def send_chunk(self, data):
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    server, url = start_server(LLMHandler)
+    return server, f"{url}/v1"
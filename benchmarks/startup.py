@@ -0,0 +1,58 @@
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay out of a cold `import nim`
+LAZY_MODULES = ["yfinance", "langchain", "langchain_core", "langchain_nvidia_ai_endpoints", "bs4", "nemoguardrails", "fastembed", "tiktoken"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import nim
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+def measure_once():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=ROOT, capture_output=True, text=True, check=True)
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    # -X importtime nests children two spaces deeper than their parent; keep nim's direct imports
+    rows = [re.match(r"import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)", line) for line in result.stderr.splitlines()]
+    rows = [(int(row.group(1)), len(row.group(2)), row.group(3)) for row in rows if row]
+    nim_depth = next(depth for _, depth, name in rows if name == "nim")
+    imports = [(micros, name) for micros, depth, name in rows if depth == nim_depth + 2]
+    sample["top_imports"] = sorted(imports, reverse=True)[:10]
+    return sample
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start import time of nim.py.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "2000")), help="fail if the median exceeds this")
+    args = parser.parse_args()
+
+    samples = [measure_once() for _ in range(args.runs)]
+    times = sorted(sample["seconds"] * 1000 for sample in samples)
+    median = statistics.median(times)
+    print(f"import nim: median {median:.0f} ms, min {times[0]:.0f} ms, max {times[-1]:.0f} ms over {args.runs} runs")
+    print("Slowest top-level imports (cumulative):")
+    for micros, name in samples[-1]["top_imports"]:
+        print(f"  {micros / 1000:8.1f} ms  {name}")
+
+    failures = []
+    loaded = sorted(set(module for sample in samples for module in sample["loaded"]))
+    if loaded:
+        failures.append(f"heavy modules imported at startup: {', '.join(loaded)}")
+    if median > args.budget_ms:
+        failures.append(f"median {median:.0f} ms exceeds budget of {args.budget_ms:.0f} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
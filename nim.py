@@ -1,149 +1,1456 @@
 import os
-import yfinance as yf
+import time
+import uuid
+import pickle
+import socket
+import json
+import importlib
+import functools
+import contextlib
+import hashlib
+import sqlite3
+import threading
+import queue
+from collections import defaultdict, deque
+from statistics import NormalDist
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache, LRUCache
 import re
-import plotly.graph_objs as go
-from plotly.subplots import make_subplots
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
-import langchain.globals
-from nemoguardrails import LLMRails, RailsConfig
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-# Initialize Nemo Guardrails
-# guardrails_config = RailsConfig.from_path("guardrails_config.yaml")
-# LLMRails(guardrails_config)
+class LazyModule:
+    # Defers importing a heavy dependency until one of its attributes is first used
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-# Set the verbose setting
-langchain.globals.set_verbose(True)
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
 
-# Get the current verbose setting
-is_verbose = langchain.globals.get_verbose()
+yf = LazyModule("yfinance")
+go = LazyModule("plotly.graph_objs")
+
+def cache_resource(func):
+    # st.cache_resource is a no-op outside `streamlit run`, so headless runs keep one instance per process
+    if st.runtime.exists():
+        return st.cache_resource(func)
+    return functools.lru_cache(maxsize=None)(func)
+
+# Nemo Guardrails is only loaded when enabled
+ENABLE_GUARDRAILS = os.getenv("ENABLE_GUARDRAILS", "0") == "1"
+GUARDRAILS_CONFIG = os.getenv("GUARDRAILS_CONFIG", "guardrails_config.yaml")
 
 # Define the system prompt for the financial assistant
 system_prompt = """You are a knowledgeable and professional financial assistant. Your role is to provide helpful advice and recommendations on personal finance topics such as budgeting, saving, investing, retirement planning, tax strategies, and more. You have access to a financial API that can provide real-time stock prices, company information, and market data. Always aim to provide actionable and practical guidance tailored to the user's specific situation."""
 
-# Initialize session state variables
-if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "system", "content": system_prompt}]
-if "conversation" not in st.session_state:
-    st.session_state.conversation = []
-if "portfolio_analysis_done" not in st.session_state:
-    st.session_state.portfolio_analysis_done = False
-if "portfolio_df" not in st.session_state:
-    st.session_state.portfolio_df = None
-if "analysis_results" not in st.session_state:
-    st.session_state.analysis_results = {}
-if "selected_stock" not in st.session_state:
-    st.session_state.selected_stock = None
+# LLM endpoint (any OpenAI-compatible server, e.g. a local NIM)
+NVIDIA_BASE_URL = os.getenv("NVIDIA_BASE_URL", "https://integrate.api.nvidia.com/v1")
+NVIDIA_MODEL = os.getenv("NVIDIA_MODEL", "meta/llama3-70b-instruct")
+
+# Concurrency settings for the portfolio analysis pipeline
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MIN_INTERVAL = float(os.getenv("LLM_MIN_INTERVAL", "0.25"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+
+# Local OHLCV store settings
+PRICE_STORE_DIR = os.getenv("PRICE_STORE_DIR", ".price_store")
+PRICE_STORE_REFRESH = int(os.getenv("PRICE_STORE_REFRESH", "3600"))
+PRICE_HISTORY_YEARS = 5
+# Relative close difference on the overlapping bar that means Yahoo has re-adjusted the history
+PRICE_ADJUSTMENT_TOLERANCE = 1e-4
+
+# Chart windows served as slices of the stored 5y history
+PERIOD_OFFSETS = {
+    "5y": pd.DateOffset(years=5),
+    "1y": pd.DateOffset(years=1),
+    "6mo": pd.DateOffset(months=6),
+    "1mo": pd.DateOffset(months=1),
+}
+
+# News search settings
+NEWS_SEARCH_URL = os.getenv("NEWS_SEARCH_URL", "https://www.google.com/search")
+NEWS_CONNECT_TIMEOUT = float(os.getenv("NEWS_CONNECT_TIMEOUT", "3"))
+NEWS_READ_TIMEOUT = float(os.getenv("NEWS_READ_TIMEOUT", "6"))
+NEWS_CACHE_TTL = int(os.getenv("NEWS_CACHE_TTL", "900"))
+NEWS_MAX_RETRIES = int(os.getenv("NEWS_MAX_RETRIES", "2"))
+NEWS_HEADLINE_CLASSES = ["n0jPhd ynAwRc tNxQIb nDgy9d", "IJl0Z"]
+NEWS_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'
+
+# Cache shared by every replica and worker process; put it on a shared volume to share it across hosts.
+# Prices live in the Parquet store (PRICE_STORE_DIR) and only use the shared cache's cross-process lock.
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", ".shared_cache.sqlite")
+SHARED_CACHE_TTLS = {
+    "prices": PRICE_STORE_REFRESH,
+    "statements": int(os.getenv("SHARED_CACHE_TTL_STATEMENTS", "86400")),
+    "news": int(os.getenv("SHARED_CACHE_TTL_NEWS", str(NEWS_CACHE_TTL))),
+    "analyses": int(os.getenv("SHARED_CACHE_TTL_ANALYSES", "86400")),
+}
+SHARED_CACHE_LOCK_TIMEOUT = float(os.getenv("SHARED_CACHE_LOCK_TIMEOUT", "120"))
+SHARED_CACHE_POLL_INTERVAL = 0.1
+# Position columns that, together with the price date, statements and news, decide whether a stored analysis is reused
+FINGERPRINT_POSITION_FIELDS = ["Quantity", "Average Cost Basis", "Cost Basis Total"]
+
+# Portfolio risk settings
+RISK_BENCHMARK = os.getenv("RISK_BENCHMARK", "QQQ")
+TRADING_DAYS = 252
+ROLLING_WINDOW = 21
+VAR_CONFIDENCE = 0.95
+
+# What-if simulation settings; rebalance periods are in trading days and 0 means buy and hold
+REBALANCE_PERIODS = {"none": 0, "monthly": 21, "quarterly": 63, "annual": 252}
+SIMULATION_RANDOM_SCENARIOS = int(os.getenv("SIMULATION_RANDOM_SCENARIOS", "1000"))
+SIMULATION_COST_BPS = float(os.getenv("SIMULATION_COST_BPS", "5"))
+SIMULATION_MAX_CELLS = int(os.getenv("SIMULATION_MAX_CELLS", "20000000"))
+SIMULATION_TOP = 10
+
+# Semantic cache settings for follow-up questions
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+# Local model directory; the model is only downloaded when it isn't there yet
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".fastembed_cache")
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", ".semantic_cache.sqlite")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "900"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "500"))
+
+# Local domain pre-filter: clearly off-topic questions are refused before any network call.
+# The margin is the best finance prototype similarity minus the best off-topic one. The filter is off and the
+# reject margin conservative until benchmarks/domain_filter.py has been run against the real embedding model.
+DOMAIN_FILTER = os.getenv("DOMAIN_FILTER", "0") == "1"
+DOMAIN_ACCEPT_MARGIN = float(os.getenv("DOMAIN_ACCEPT_MARGIN", "0.05"))
+DOMAIN_REJECT_MARGIN = float(os.getenv("DOMAIN_REJECT_MARGIN", "-0.15"))
+DOMAIN_REFUSAL = "I'm sorry, but I can only provide information related to finance and stocks."
+FINANCE_KEYWORDS = (
+    r"\b(stocks?|shares?|portfolios?|invest\w*|markets?|etfs?|bonds?|dividends?|earnings|valuations?|p/e|interest rates?|inflation|"
+    r"treasur(y|ies)|crypto\w*|bitcoin|ira|401k|retirement|hedg\w*|tickers?|nasdaq|s&p|dow jones|index funds?|mutual funds?|"
+    r"brokerage|capital gains?|rebalanc\w*|asset allocation|diversif\w*|volatility|yields?|federal reserve|recession|financ\w*)\b"
+)
+FINANCE_PROTOTYPES = [
+    "Should I buy or sell this stock?",
+    "How is my portfolio performing?",
+    "What is the outlook for the stock market this year?",
+    "Explain the difference between an ETF and a mutual fund.",
+    "How do interest rates affect bond prices?",
+    "What are the company's revenue and earnings trends?",
+    "Is this company overvalued based on its P/E ratio?",
+    "How should I diversify my investments?",
+    "What are the tax implications of selling shares at a loss?",
+    "How much should I save for retirement?",
+    "What happened to tech stocks after the earnings reports?",
+    "How does inflation impact my savings and investments?",
+]
+OFF_TOPIC_PROTOTYPES = [
+    "What is the coronavirus?",
+    "What's the weather like tomorrow?",
+    "Give me a recipe for chocolate cake.",
+    "Who won the football game last night?",
+    "Write a poem about the ocean.",
+    "How do I fix a bug in my Python code?",
+    "What are the symptoms of the flu?",
+    "Recommend a good movie to watch tonight.",
+    "Plan a trip to Paris for me.",
+    "Who was the first president of the United States?",
+    "Tell me a joke.",
+    "How do I train my dog to sit?",
+]
+
+# Prompt token budgets per section (counted with tiktoken's cl100k_base encoding)
+PROMPT_TOKEN_BUDGETS = {
+    "stock_data": int(os.getenv("PROMPT_BUDGET_STOCK_DATA", "80")),
+    "financials": int(os.getenv("PROMPT_BUDGET_FINANCIALS", "350")),
+    "news": int(os.getenv("PROMPT_BUDGET_NEWS", "400")),
+    "portfolio": int(os.getenv("PROMPT_BUDGET_PORTFOLIO", "400")),
+}
+FINANCIAL_ROWS = [
+    ("Revenue", "Total Revenue"),
+    ("Gross Profit", "Gross Profit"),
+    ("Operating Income", "Operating Income"),
+    ("Net Income", "Net Income"),
+    ("EBITDA", "EBITDA"),
+    ("Diluted EPS", "Diluted EPS"),
+]
+BALANCE_ROWS = [
+    ("Total Debt", "Total Debt"),
+    ("Cash", "Cash And Cash Equivalents"),
+    ("Equity", "Stockholders Equity"),
+]
+PORTFOLIO_PROMPT_COLUMNS = ["Symbol", "Description", "Quantity", "Last Price", "Current Value", "Total Gain/Loss Percent", "Percent Of Account"]
+
+# Declared schema for brokerage position exports; unknown columns are kept as strings
+POSITION_SCHEMA = {
+    "Account Number": "string",
+    "Account Name": "string",
+    "Symbol": "string",
+    "Description": "string",
+    "Quantity": "number",
+    "Last Price": "currency",
+    "Last Price Change": "currency",
+    "Current Value": "currency",
+    "Today's Gain/Loss Dollar": "currency",
+    "Today's Gain/Loss Percent": "percent",
+    "Total Gain/Loss Dollar": "currency",
+    "Total Gain/Loss Percent": "percent",
+    "Percent Of Account": "percent",
+    "Cost Basis Total": "currency",
+    "Average Cost Basis": "currency",
+    "Type": "string",
+}
+POSITIONS_CHUNK_ROWS = int(os.getenv("POSITIONS_CHUNK_ROWS", "50000"))
+CASH_SYMBOL_PATTERN = r"(?:\*\*$|^CASH$|^CORE$|^PENDING ACTIVITY$)"
+
+# Charts are drawn with WebGL traces downsampled to roughly one point per pixel of a full-width chart
+CHART_POINT_BUDGET = int(os.getenv("CHART_POINT_BUDGET", "800"))
+CHART_DOWNSAMPLE = os.getenv("CHART_DOWNSAMPLE", "lttb")
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "64"))
+
+# Tracing: spans are kept in memory for the debug panel and appended to TRACE_FILE as JSON lines when set
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "2000"))
+DEBUG_PANEL = os.getenv("DEBUG_PANEL", "0") == "1"
+TRACE_COUNTERS = ["bytes", "prompt_tokens", "completion_tokens"]
+
+class Tracer:
+    def __init__(self, buffer_size=TRACE_BUFFER_SIZE, export_path=TRACE_FILE):
+        self.spans = deque(maxlen=buffer_size)
+        self.export_path = export_path
+        # Running totals survive the ring buffer so exported counters only ever increase
+        self.totals = defaultdict(float)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        record = {"name": name, "parent": stack[-1]["name"] if stack else None, "thread": threading.current_thread().name,
+                  "start": time.time(), **attributes}
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            record["duration_ms"] = (time.perf_counter() - start) * 1000
+            stack.pop()
+            self.record(record)
+
+    def annotate(self, **attributes):
+        stack = self._stack()
+        if stack:
+            stack[-1].update(attributes)
+
+    def traced(self, name=None, cached=False):
+        # Cached functions start as hits; their body calls annotate(cache="miss") when it actually runs
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, **({"cache": "hit"} if cached else {})):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, record, export=True):
+        with self._lock:
+            self.spans.append(record)
+            name = record["name"]
+            self.totals[("count", name)] += 1
+            self.totals[("seconds", name)] += record["duration_ms"] / 1000
+            for counter in TRACE_COUNTERS:
+                self.totals[(counter, name)] += record.get(counter) or 0
+            if record.get("cache"):
+                self.totals[(f"cache_{record['cache']}", name)] += 1
+            if record.get("error"):
+                self.totals[("errors", name)] += 1
+            if export and self.export_path:
+                with open(self.export_path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def ingest(self, records):
+        # Spans collected in worker processes; those processes leave the file export to the parent
+        for record in records:
+            self.record(record)
+
+    def drain(self):
+        with self._lock:
+            records = list(self.spans)
+            self.spans.clear()
+        return records
+
+    def to_jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(record, default=str) + "\n" for record in self.spans)
+
+    def summary(self):
+        with self._lock:
+            spans = pd.DataFrame(list(self.spans))
+        if spans.empty:
+            return spans
+        spans = spans.reindex(columns=list(spans.columns) + [c for c in TRACE_COUNTERS + ["cache", "error"] if c not in spans.columns])
+        grouped = spans.groupby("name")
+        summary = pd.DataFrame({
+            "count": grouped.size(),
+            "p50_ms": grouped["duration_ms"].median(),
+            "p95_ms": grouped["duration_ms"].quantile(0.95),
+            "max_ms": grouped["duration_ms"].max(),
+            **{counter: grouped[counter].sum() for counter in TRACE_COUNTERS},
+            "cache_hits": (spans["cache"] == "hit").groupby(spans["name"]).sum(),
+            "cache_misses": (spans["cache"] == "miss").groupby(spans["name"]).sum(),
+            "errors": spans["error"].notna().groupby(spans["name"]).sum(),
+        })
+        return summary.sort_values("p95_ms", ascending=False)
+
+    def to_prometheus(self):
+        # Quantiles come from the in-memory window, counters from the running totals
+        summary = self.summary()
+        with self._lock:
+            totals = dict(self.totals)
+        lines = ["# HELP span_duration_seconds Span duration by span name.", "# TYPE span_duration_seconds summary"]
+        for name, row in summary.iterrows():
+            for quantile, column in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+                lines.append(f'span_duration_seconds{{span="{name}",quantile="{quantile}"}} {row[column] / 1000:.6f}')
+        names = sorted({name for _, name in totals})
+        for name in names:
+            lines.append(f'span_duration_seconds_sum{{span="{name}"}} {totals[("seconds", name)]:.6f}')
+            lines.append(f'span_duration_seconds_count{{span="{name}"}} {totals[("count", name)]:.0f}')
+        for metric, help_text in (("bytes", "Bytes fetched or returned."), ("prompt_tokens", "Prompt tokens sent to the LLM."),
+                                  ("completion_tokens", "Completion tokens streamed from the LLM."), ("errors", "Spans that raised.")):
+            lines += [f"# HELP span_{metric}_total {help_text}", f"# TYPE span_{metric}_total counter"]
+            lines += [f'span_{metric}_total{{span="{name}"}} {totals[(metric, name)]:.0f}' for name in names if totals.get((metric, name))]
+        lines += ["# HELP span_cache_total Cache lookups by result.", "# TYPE span_cache_total counter"]
+        for name in names:
+            for result in ("hit", "miss"):
+                if (f"cache_{result}", name) in totals:
+                    lines.append(f'span_cache_total{{span="{name}",result="{result}"}} {totals[(f"cache_{result}", name)]:.0f}')
+        return "\n".join(lines) + "\n"
+
+tracer = Tracer()
+
+def init_session_state():
+    # Initialize session state variables
+    if "messages" not in st.session_state:
+        st.session_state.messages = [{"role": "system", "content": system_prompt}]
+    if "conversation" not in st.session_state:
+        st.session_state.conversation = []
+    if "portfolio_analysis_done" not in st.session_state:
+        st.session_state.portfolio_analysis_done = False
+    if "portfolio_df" not in st.session_state:
+        st.session_state.portfolio_df = None
+    if "analysis_results" not in st.session_state:
+        st.session_state.analysis_results = {}
+    if "selected_stock" not in st.session_state:
+        st.session_state.selected_stock = None
+    if "pending_query" not in st.session_state:
+        st.session_state.pending_query = None
+    if "analysis_metrics" not in st.session_state:
+        st.session_state.analysis_metrics = {}
+    if "llm_metrics" not in st.session_state:
+        st.session_state.llm_metrics = []
+    if "view_models" not in st.session_state:
+        st.session_state.view_models = {}
+    if "conversation_html" not in st.session_state:
+        st.session_state.conversation_html = ""
+    if "portfolio_file_id" not in st.session_state:
+        st.session_state.portfolio_file_id = None
+    if "simulation" not in st.session_state:
+        st.session_state.simulation = None
+
+class PositionLoader:
+    @staticmethod
+    def parse_numeric(values, kind):
+        text = values.astype("string[pyarrow]").str.strip()
+        # Accounting negatives like "(12.34)" become "-12.34"; "--" and blanks become missing
+        text = text.str.replace(r"^\((.*)\)$", r"-\1", regex=True)
+        text = text.str.replace(r"[$,%+\s]", "", regex=True)
+        return pd.to_numeric(text, errors="coerce").astype("float64[pyarrow]")
+
+    @staticmethod
+    def clean(chunk):
+        chunk = chunk.rename(columns=lambda column: str(column).strip())
+        chunk["Symbol"] = chunk["Symbol"].str.strip()
+        # Footer rows (disclaimers, download timestamps) carry text in the first column only
+        footer = chunk.drop(columns=["Symbol"]).isna().all(axis=1) | chunk["Symbol"].isna() | (chunk["Symbol"] == "")
+        chunk = chunk.loc[~footer]
+        for column in chunk.columns:
+            kind = POSITION_SCHEMA.get(column, "string")
+            if kind == "string":
+                chunk[column] = chunk[column].astype("string[pyarrow]")
+            else:
+                chunk[column] = PositionLoader.parse_numeric(chunk[column], kind)
+        return chunk
+
+    @staticmethod
+    def load(source, chunk_rows=POSITIONS_CHUNK_ROWS):
+        # index_col=False keeps the columns in place when data rows end with a trailing comma, as brokerage exports often do
+        reader = pd.read_csv(source, dtype=str, encoding="utf-8-sig", skipinitialspace=True, on_bad_lines="skip", index_col=False, chunksize=chunk_rows)
+        positions = pd.concat([PositionLoader.clean(chunk) for chunk in reader], ignore_index=True)
+        cash = positions["Symbol"].str.upper().str.contains(CASH_SYMBOL_PATTERN, regex=True, na=False).astype(bool)
+        # Cash and pending rows have no market data, so they are kept out of the holdings. Their value is also
+        # kept per account, for exports that are split into one portfolio per account
+        cash_values = positions.loc[cash, "Current Value"] if "Current Value" in positions else pd.Series(dtype="float64")
+        positions.attrs["cash_value"] = float(cash_values.sum())
+        if "Account Number" in positions:
+            positions.attrs["account_cash"] = {number: float(value) for number, value in cash_values.groupby(positions.loc[cash, "Account Number"]).sum().items()}
+        return positions.loc[~cash].reset_index(drop=True)
+
+class SharedCache:
+    def __init__(self, path=SHARED_CACHE_PATH, ttls=SHARED_CACHE_TTLS, lock_timeout=SHARED_CACHE_LOCK_TIMEOUT):
+        self.path = path
+        self.ttls = ttls
+        self.lock_timeout = lock_timeout
+        self._locks = defaultdict(threading.Lock)
+        self._conn_lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # SQLite connections must not cross a fork, so each worker process opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, namespace, key):
+        with self._conn_lock:
+            row = self.conn.execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ? AND expires_at > ?", (namespace, key, time.time())
+            ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttls[namespace] if ttl is None else ttl)
+        with self._conn_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires_at),
+            )
+            self.conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+
+    def _acquire(self, name, owner):
+        # A lease row; an expired lease (its holder crashed) is taken over
+        now = time.time()
+        with self._conn_lock:
+            cursor = self.conn.execute(
+                "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at WHERE locks.expires_at < ?",
+                (name, owner, now + self.lock_timeout, now),
+            )
+            return cursor.rowcount == 1
+
+    def _renew(self, name, owner, stop):
+        # Extends a held lease while its fetch runs, so a long LLM generation with retries isn't taken over
+        while not stop.wait(self.lock_timeout / 3):
+            with self._conn_lock:
+                self.conn.execute("UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?", (time.time() + self.lock_timeout, name, owner))
+
+    def _release(self, name, owner):
+        with self._conn_lock:
+            self.conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    @contextlib.contextmanager
+    def lock(self, namespace, key):
+        # Threads queue on an in-process lock, processes on the lease row
+        name = f"{namespace}:{key}"
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        with self._locks[name]:
+            while not self._acquire(name, owner):
+                time.sleep(SHARED_CACHE_POLL_INTERVAL)
+            stop = threading.Event()
+            renewal = threading.Thread(target=self._renew, args=(name, owner, stop), daemon=True)
+            renewal.start()
+            try:
+                yield
+            finally:
+                stop.set()
+                renewal.join()
+                self._release(name, owner)
+
+    def get_or_fetch(self, namespace, key, fetch, ttl=None):
+        # Single flight: concurrent callers for a missing key wait for one fetch instead of each going upstream.
+        # Exceptions propagate and nothing is stored, so failures are retried by the next caller.
+        value = self.get(namespace, key)
+        if value is not None:
+            tracer.annotate(cache="hit", shared_cache="hit")
+            return value
+        with self.lock(namespace, key):
+            value = self.get(namespace, key)
+            if value is not None:
+                tracer.annotate(cache="hit", shared_cache="hit")
+                return value
+            tracer.annotate(cache="miss", shared_cache="miss")
+            value = fetch()
+            self.set(namespace, key, value, ttl)
+            return value
+
+shared_cache = SharedCache()
+
+class PriceStore:
+    def __init__(self, root=PRICE_STORE_DIR, refresh_seconds=PRICE_STORE_REFRESH):
+        self.root = root
+        self.refresh_seconds = refresh_seconds
+
+    def path(self, symbol):
+        return os.path.join(self.root, re.sub(r"[^A-Za-z0-9._-]", "_", symbol.upper()) + ".parquet")
+
+    def load(self, symbol):
+        path = self.path(symbol)
+        if not os.path.exists(path):
+            return None
+        # Memory-map the Parquet file so the columns are read without an extra buffer copy
+        return pq.read_table(path, memory_map=True).to_pandas()
+
+    def is_fresh(self, symbol):
+        path = self.path(symbol)
+        return os.path.exists(path) and time.time() - os.path.getmtime(path) < self.refresh_seconds
+
+    def save(self, symbol, data):
+        data = data.loc[data.index >= data.index.max() - pd.DateOffset(years=PRICE_HISTORY_YEARS)]
+        path = self.path(symbol)
+        # The directory is created on the first write, so importing the module leaves the disk untouched
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        pq.write_table(pa.Table.from_pandas(data), tmp_path)
+        os.replace(tmp_path, path)
+        return data
+
+    @staticmethod
+    def delta_start(data):
+        # The delta overlaps the last completed bar (the newest one may be an intraday snapshot) so a re-adjusted history can be detected
+        if data is None or data.empty:
+            return None
+        return data.index[-2] if len(data) > 1 else data.index[-1]
+
+    @staticmethod
+    def needs_rebase(existing, new_data):
+        # Adjusted bars are re-based by Yahoo on every split or dividend, so a delta after one can't be spliced onto the stored bars
+        if existing is None or existing.empty or new_data is None or new_data.empty:
+            return False
+        new_data = PriceStore.normalize(new_data)
+        actions = new_data.loc[new_data.index > existing.index.max(), [column for column in ("Dividends", "Stock Splits") if column in new_data]]
+        if (actions.fillna(0.0) != 0).to_numpy().any():
+            return True
+        overlap = new_data.index.intersection(existing.index[existing.index < existing.index.max()])
+        if overlap.empty:
+            return False
+        drift = new_data.loc[overlap, "Close"].to_numpy(dtype=float) / existing.loc[overlap, "Close"].to_numpy(dtype=float) - 1.0
+        return bool((np.abs(drift) > PRICE_ADJUSTMENT_TOLERANCE).any())
+
+    def merge(self, symbol, existing, new_data):
+        if new_data is None or new_data.empty:
+            if existing is None or existing.empty:
+                raise ValueError(f"No price history returned for {symbol}")
+            os.utime(self.path(symbol))
+            return existing
+        new_data = PriceStore.normalize(new_data)
+        if existing is not None and not existing.empty:
+            # The last stored bar may have been an intraday snapshot, so the fresh copy wins
+            new_data = pd.concat([existing, new_data])
+            new_data = new_data[~new_data.index.duplicated(keep="last")].sort_index()
+        return self.save(symbol, new_data)
+
+    @tracer.traced(cached=True)
+    def get(self, symbol, fetch):
+        if self.is_fresh(symbol):
+            data = self.load(symbol)
+            if data is not None and not data.empty:
+                return data
+        # Replicas sharing PRICE_STORE_DIR refresh a stale symbol once; the others read the result
+        with shared_cache.lock("prices", symbol.upper()):
+            data = self.load(symbol)
+            if data is not None and not data.empty and self.is_fresh(symbol):
+                return data
+            tracer.annotate(cache="miss")
+            start = PriceStore.delta_start(data)
+            new_data = fetch(symbol, start)
+            if PriceStore.needs_rebase(data, new_data):
+                tracer.annotate(rebased=True)
+                data, new_data = None, fetch(symbol, None)
+            return self.merge(symbol, data, new_data)
+
+    @tracer.traced()
+    def get_many(self, symbols, fetch_many):
+        stale = {symbol: self.load(symbol) for symbol in symbols if not self.is_fresh(symbol)}
+        # Cold symbols need the full window, warm ones only the bars since the oldest last bar
+        cold = [symbol for symbol, data in stale.items() if data is None or data.empty]
+        warm = [symbol for symbol in stale if symbol not in cold]
+        batches = []
+        if cold:
+            batches.append((cold, None))
+        if warm:
+            batches.append((warm, min(PriceStore.delta_start(stale[symbol]) for symbol in warm)))
+        while batches:
+            batch, start = batches.pop(0)
+            downloaded = fetch_many(batch, start)
+            rebase = []
+            for symbol in batch:
+                # Symbols missing from the batch fall back to a per-symbol fetch in get()
+                if symbol not in downloaded or downloaded[symbol].empty:
+                    continue
+                if start is not None and PriceStore.needs_rebase(stale[symbol], downloaded[symbol]):
+                    # Re-adjusted after a split or dividend: replaced by the full window below
+                    stale[symbol] = None
+                    rebase.append(symbol)
+                    continue
+                with shared_cache.lock("prices", symbol.upper()):
+                    self.merge(symbol, stale[symbol], downloaded[symbol])
+            if rebase:
+                tracer.annotate(rebased=len(rebase))
+                batches.append((rebase, None))
+
+    @staticmethod
+    def normalize(data):
+        data = data.copy()
+        data.index = pd.DatetimeIndex(data.index)
+        if data.index.tz is not None:
+            data.index = data.index.tz_localize(None)
+        data.index.name = "Date"
+        return data
+
+price_store = PriceStore()
 
 class DataFetcher:
     @staticmethod
-    @st.cache_data
+    @tracer.traced()
+    def download_histories(symbols, start=None):
+        period_kwargs = {"period": f"{PRICE_HISTORY_YEARS}y"} if start is None else {"start": start.strftime("%Y-%m-%d")}
+        data = yf.download(symbols, group_by="ticker", auto_adjust=True, actions=True, threads=True, progress=False, **period_kwargs)
+        tracer.annotate(bytes=int(data.memory_usage().sum()), symbols=len(symbols))
+        if not isinstance(data.columns, pd.MultiIndex):
+            return {symbols[0]: data}
+        available = set(data.columns.get_level_values(0))
+        return {symbol: data[symbol].dropna(how="all") for symbol in symbols if symbol in available}
+
+    @staticmethod
+    @tracer.traced()
+    def prefetch_stock_data(symbols):
+        # One multi-ticker request fills the store; get_stock_data then reads it without network calls
+        try:
+            price_store.get_many(list(dict.fromkeys(symbols)), DataFetcher.download_histories)
+        except Exception as e:
+            st.write(f"Error: Unable to batch download stock data. {str(e)}")
+
+    @staticmethod
+    def slice_period(stock_data, period):
+        if period.endswith("d"):
+            return stock_data.tail(int(period[:-1]))
+        return stock_data.loc[stock_data.index >= stock_data.index.max() - PERIOD_OFFSETS[period]]
+
+    @staticmethod
+    @tracer.traced()
+    def fetch_history(symbol, start=None):
+        ticker_yahoo = yf.Ticker(symbol)
+        if start is None:
+            data = ticker_yahoo.history(period=f"{PRICE_HISTORY_YEARS}y")
+        else:
+            data = ticker_yahoo.history(start=start.strftime("%Y-%m-%d"))
+        tracer.annotate(bytes=int(data.memory_usage().sum()))
+        return data
+
+    @staticmethod
+    @tracer.traced("DataFetcher.get_stock_data", cached=True)
     def get_stock_data(symbol):
+        # Failures become error values outside the cached loader, so they are never cached and the next call retries
         try:
-            ticker_yahoo = yf.Ticker(symbol)
-            data = ticker_yahoo.history(period="5y")
+            data = DataFetcher.load_stock_data(symbol)
             last_quote = data['Close'].iloc[-1]
             return data, f"Symbol: {symbol}\nPrice: {last_quote}\n"
         except Exception as e:
             return None, f"Error: Unable to retrieve stock data for symbol {symbol}. {str(e)}"
 
     @staticmethod
-    @st.cache_data
+    @st.cache_data(ttl=PRICE_STORE_REFRESH)
+    def load_stock_data(symbol):
+        tracer.annotate(cache="miss")
+        return price_store.get(symbol, DataFetcher.fetch_history)
+
+    @staticmethod
+    @tracer.traced("DataFetcher.get_financial_statements", cached=True)
     def get_financial_statements(symbol):
         try:
-            stock = yf.Ticker(symbol)
-            financial_statements = stock.quarterly_financials
-            return financial_statements
+            return DataFetcher.load_financial_statements(symbol)
         except Exception as e:
             return None, f"Error: Unable to retrieve financial statements for symbol {symbol}. {str(e)}"
 
+    @staticmethod
+    @st.cache_data(ttl=SHARED_CACHE_TTLS["statements"])
+    def load_financial_statements(symbol):
+        tracer.annotate(cache="miss")
+        return shared_cache.get_or_fetch("statements", symbol, lambda: DataFetcher.fetch_financial_statements(symbol))
+
+    @staticmethod
+    def fetch_financial_statements(symbol):
+        stock = yf.Ticker(symbol)
+        financial_statements = pd.concat([stock.quarterly_financials, stock.quarterly_balance_sheet])
+        if financial_statements.empty:
+            # yfinance returns empty frames when a request fails; raising keeps them out of both caches
+            raise ValueError("No financial statements were returned")
+        tracer.annotate(bytes=int(financial_statements.memory_usage().sum()))
+        return financial_statements
+
     @staticmethod
     def google_query(search_term):
         if "news" not in search_term:
             search_term = search_term + " stock news"
-        url = f"https://www.google.com/search?q={search_term}&cr=countryUS"
+        url = f"{NEWS_SEARCH_URL}?q={search_term}&cr=countryUS"
         url = re.sub(r"\s", "+", url)
         return url
 
     @staticmethod
+    @tracer.traced(cached=True)
     def get_recent_stock_news(company_name):
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'}
-        if company_name != "stock":
-            g_query = DataFetcher.google_query(company_name)
-        else:
-            g_query = DataFetcher.google_query("top 10 recent stocks related news only")
-        res = requests.get(g_query, headers=headers).text
-        soup = BeautifulSoup(res, "html.parser")
+        return news_fetcher.fetch(company_name)
+
+class NewsFetcher:
+    def __init__(self, session=None, timeout=(NEWS_CONNECT_TIMEOUT, NEWS_READ_TIMEOUT), ttl=NEWS_CACHE_TTL, max_workers=FETCH_MAX_WORKERS):
+        self.session = session or NewsFetcher.build_session(max_workers)
+        self.timeout = timeout
+        self.cache = TTLCache(maxsize=1024, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def build_session(pool_size=FETCH_MAX_WORKERS):
+        session = requests.Session()
+        retry = Retry(total=NEWS_MAX_RETRIES, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = NEWS_USER_AGENT
+        return session
+
+    @staticmethod
+    def parse(html):
+        # Only the headline divs are built into the tree; lxml does the tokenizing
+        from bs4 import BeautifulSoup, SoupStrainer
+        soup = BeautifulSoup(html, "lxml", parse_only=SoupStrainer("div", class_=NEWS_HEADLINE_CLASSES))
         news = []
-        for n in soup.find_all("div", "n0jPhd ynAwRc tNxQIb nDgy9d"):
-            news.append(n.text)
-        for n in soup.find_all("div", "IJl0Z"):
-            news.append(n.text)
+        for css_class in NEWS_HEADLINE_CLASSES:
+            news.extend(n.text for n in soup.find_all("div", css_class))
+        return news[:10]
 
-        if len(news) > 10:
-            news = news[:10]
-        else:
-            news = news
+    @staticmethod
+    def format(news):
         news_string = ""
         for i, n in enumerate(news):
             news_string += f"{i+1}. {n}\n"
-        top_news = "Recent News:\n\n" + news_string
+        return "Recent News:\n\n" + news_string
 
+    def fetch(self, company_name):
+        with self._lock:
+            if company_name in self.cache:
+                return self.cache[company_name]
+        tracer.annotate(cache="miss")
+        try:
+            top_news = shared_cache.get_or_fetch("news", company_name, lambda: self.download(company_name))
+        except requests.RequestException as e:
+            # Failures are not cached so the next request tries again
+            return f"Error: Unable to retrieve recent news for {company_name}. {str(e)}"
+        with self._lock:
+            self.cache[company_name] = top_news
         return top_news
 
+    def download(self, company_name):
+        if company_name != "stock":
+            g_query = DataFetcher.google_query(company_name)
+        else:
+            g_query = DataFetcher.google_query("top 10 recent stocks related news only")
+        response = self.session.get(g_query, timeout=self.timeout)
+        response.raise_for_status()
+        tracer.annotate(bytes=len(response.content))
+        return NewsFetcher.format(NewsFetcher.parse(response.content))
+
+news_fetcher = NewsFetcher()
+
+class RiskEngine:
+    @staticmethod
+    def align_closes(price_frames):
+        # Dates are the union of every history; a holding listed later keeps NaN before its first close,
+        # so it doesn't cut the other holdings' or the benchmark's history short
+        closes = pd.concat({symbol: data['Close'] for symbol, data in price_frames.items()}, axis=1)
+        return closes.sort_index().ffill().dropna(how="all")
+
+    @staticmethod
+    def data_version(price_frames):
+        return tuple((symbol, str(data.index.max()), len(data)) for symbol, data in sorted(price_frames.items()))
+
+    @staticmethod
+    def pairwise_beta(returns, bench_returns):
+        # Each asset is regressed on the benchmark over the days both have a return
+        mask = ~np.isnan(returns) & ~np.isnan(bench_returns)[:, None]
+        count = mask.sum(axis=0)
+        asset = np.where(mask, returns, 0.0)
+        bench = np.where(mask, bench_returns[:, None], 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            asset_centered = np.where(mask, asset - asset.sum(axis=0) / count, 0.0)
+            bench_centered = np.where(mask, bench - bench.sum(axis=0) / count, 0.0)
+            return (asset_centered * bench_centered).sum(axis=0) / (bench_centered ** 2).sum(axis=0)
+
+    @staticmethod
+    def compute(symbols, weights, closes, benchmark=RISK_BENCHMARK):
+        # Every metric below is one vectorized pass over the aligned T x N price matrix. Per-asset statistics use
+        # each column's own history and covariance, correlation and beta use the pairwise overlap.
+        prices = closes[symbols].to_numpy(dtype=float)
+        returns = prices[1:] / prices[:-1] - 1.0
+        weights = np.asarray(weights, dtype=float)
+        weights = weights / weights.sum() if weights.sum() > 0 else np.full(len(symbols), 1.0 / len(symbols))
+
+        daily_vol = np.nanstd(returns, axis=0, ddof=1)
+        window = min(ROLLING_WINDOW, len(returns))
+        rolling_vol = np.lib.stride_tricks.sliding_window_view(returns, window, axis=0).std(axis=-1, ddof=1) * np.sqrt(TRADING_DAYS)
+        returns_df = pd.DataFrame(returns)
+        covariance = returns_df.cov(min_periods=2).to_numpy()
+        correlation = returns_df.corr(min_periods=2).to_numpy()
+        drawdowns = prices / np.fmax.accumulate(prices, axis=0) - 1.0
+
+        if benchmark in closes:
+            bench = closes[benchmark].to_numpy(dtype=float)
+            beta = RiskEngine.pairwise_beta(returns, bench[1:] / bench[:-1] - 1.0)
+        else:
+            beta = np.full(len(symbols), np.nan)
+
+        tail = (1.0 - VAR_CONFIDENCE) * 100
+        z = NormalDist().inv_cdf(1.0 - VAR_CONFIDENCE)
+        # Before a holding's first close its weight is spread over the holdings that were trading
+        available = ~np.isnan(returns)
+        held_weight = available @ weights
+        portfolio_returns = (np.nan_to_num(returns) @ weights / np.where(held_weight > 0, held_weight, 1.0))[held_weight > 0]
+        portfolio_equity = np.cumprod(1.0 + portfolio_returns)
+
+        assets = pd.DataFrame({
+            "Weight": weights,
+            "Daily Volatility": daily_vol,
+            "Annualized Volatility": daily_vol * np.sqrt(TRADING_DAYS),
+            "Rolling Volatility": rolling_vol[-1],
+            "Beta": beta,
+            "Max Drawdown": np.nanmin(drawdowns, axis=0),
+            "Historical VaR": -np.nanpercentile(returns, tail, axis=0),
+            "Parametric VaR": -(np.nanmean(returns, axis=0) + z * daily_vol),
+        }, index=symbols)
+        portfolio = {
+            "Annualized Volatility": float(portfolio_returns.std(ddof=1) * np.sqrt(TRADING_DAYS)),
+            "Beta": float(np.nansum(weights * beta)),
+            "Max Drawdown": float((portfolio_equity / np.maximum.accumulate(portfolio_equity) - 1.0).min()),
+            "Historical VaR": float(-np.percentile(portfolio_returns, tail)),
+            "Parametric VaR": float(-(portfolio_returns.mean() + z * portfolio_returns.std(ddof=1))),
+        }
+        return {
+            "assets": assets,
+            "portfolio": portfolio,
+            "covariance": pd.DataFrame(covariance * TRADING_DAYS, index=symbols, columns=symbols),
+            "correlation": pd.DataFrame(correlation, index=symbols, columns=symbols),
+            "rolling_volatility": pd.DataFrame(rolling_vol, index=closes.index[window:], columns=symbols),
+            "benchmark": benchmark,
+        }
+
+@tracer.traced("compute_portfolio_risk", cached=True)
+@st.cache_data(max_entries=32)
+def compute_portfolio_risk(symbols, weights, version, _closes, benchmark=RISK_BENCHMARK):
+    tracer.annotate(cache="miss")
+    # version identifies the price data, so _closes itself is never hashed
+    return RiskEngine.compute(list(symbols), list(weights), _closes, benchmark)
+
+def position_weights(portfolio_df):
+    # Market-value weights, so holdings from several accounts combine correctly; percents of different
+    # account totals can't be added up. Cash counts towards the total, so the weights leave its share in cash
+    values = portfolio_df.groupby('Symbol', sort=False)['Current Value'].sum().astype("float64").fillna(0.0).clip(lower=0.0)
+    total = values.sum() + max(portfolio_df.attrs.get("cash_value", 0.0), 0.0)
+    return (values / total).to_dict() if total > 0 else {}
+
+def load_price_frames(symbols):
+    # Symbols whose prices can't be loaded are left out; callers treat them as missing
+    price_frames = {}
+    for symbol in dict.fromkeys(symbols):
+        stock_data, _ = DataFetcher.get_stock_data(symbol)
+        if stock_data is not None and not stock_data.empty:
+            price_frames[symbol] = stock_data
+    return price_frames
+
+@tracer.traced()
+def get_portfolio_risk(portfolio_df, benchmark=RISK_BENCHMARK):
+    weights = position_weights(portfolio_df)
+    price_frames = load_price_frames(list(weights) + [benchmark])
+    symbols = tuple(symbol for symbol in weights if symbol in price_frames)
+    if not symbols:
+        return None
+    closes = RiskEngine.align_closes(price_frames)
+    return compute_portfolio_risk(symbols, tuple(weights[symbol] for symbol in symbols), RiskEngine.data_version(price_frames), closes, benchmark)
+
+class Simulator:
+    @staticmethod
+    def stop_mask(prices, stop_loss):
+        # A position is sold to cash at the close where it first falls stop_loss below its running peak,
+        # so every later return of that asset is masked out
+        drawdowns = prices / np.fmax.accumulate(prices, axis=0) - 1.0
+        stopped = np.maximum.accumulate(drawdowns <= -stop_loss, axis=0)
+        return ~stopped[:-1]
+
+    @staticmethod
+    def run(prices, weights, rebalance_days=0, stop_loss=0.0, cost=0.0):
+        # prices is T x N and weights S x N with any remainder held as cash. All S scenarios are simulated
+        # together: within a rebalance block each holding grows by its cumulative return since the block start,
+        # so the scenario equity is one (S x N) @ (N x T) product scaled by the equity carried into each block.
+        # A holding's weight stays in cash until its first close, so a late listing doesn't shorten the replay
+        growth = np.nan_to_num(prices[1:] / prices[:-1], nan=1.0)
+        if stop_loss > 0:
+            growth = np.where(Simulator.stop_mask(prices, stop_loss), growth, 1.0)
+        weights = np.asarray(weights, dtype=float)
+        cash = np.clip(1.0 - weights.sum(axis=1), 0.0, None)
+        periods = len(growth)
+        starts = np.arange(0, periods, rebalance_days if rebalance_days > 0 else periods)
+        block = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, periods)))
+        levels = np.vstack([np.zeros(prices.shape[1]), np.cumsum(np.log(growth), axis=0)])
+        relative = np.exp(levels[1:] - levels[starts][block])
+        multiplier = weights @ relative.T + cash[:, None]
+
+        ends = np.append(starts[1:], periods) - 1
+        block_growth = multiplier[:, ends]
+        turnover = Simulator.turnover(weights, cash, relative[ends[:-1]], block_growth[:, :-1])
+        factors = block_growth[:, :-1] * (1.0 - cost * turnover)
+        carried = np.hstack([np.ones((len(weights), 1)), np.cumprod(factors, axis=1)])
+        equity = np.hstack([np.ones((len(weights), 1)), carried[:, block] * multiplier])
+        return equity, turnover
+
+    @staticmethod
+    def turnover(weights, cash, relative, block_growth):
+        # One-sided turnover at each rebalance: half the distance between the drifted and the target weights.
+        # Scenarios are processed in chunks so the S x rebalances x N intermediate stays within SIMULATION_MAX_CELLS.
+        result = np.empty(block_growth.shape)
+        chunk = max(1, SIMULATION_MAX_CELLS // max(1, relative.size))
+        for start in range(0, len(weights), chunk):
+            target, growth = weights[start:start + chunk], block_growth[start:start + chunk]
+            # |w * r / g - w| is w * |r / g - 1| for non-negative weights; worked in place so a chunk is one array
+            drift = np.divide(relative[None, :, :], growth[:, :, None])
+            drift -= 1.0
+            np.abs(drift, out=drift)
+            drifted_cash = cash[start:start + chunk, None] / growth
+            result[start:start + chunk] = 0.5 * (np.einsum("srn,sn->sr", drift, target)
+                                                 + np.abs(drifted_cash - cash[start:start + chunk, None]))
+        return result
+
+    @staticmethod
+    def summarize(equity, turnover, dates):
+        years = max((dates[-1] - dates[0]).days / 365.25, 1.0 / TRADING_DAYS)
+        returns = equity[:, 1:] / equity[:, :-1] - 1.0
+        volatility = returns.std(axis=1, ddof=1) * np.sqrt(TRADING_DAYS)
+        mean = returns.mean(axis=1) * TRADING_DAYS
+        return pd.DataFrame({
+            "Total Return": equity[:, -1] - 1.0,
+            "CAGR": equity[:, -1] ** (1.0 / years) - 1.0,
+            "Annualized Volatility": volatility,
+            "Sharpe Ratio": np.divide(mean, volatility, out=np.zeros_like(mean), where=volatility > 0),
+            "Max Drawdown": (equity / np.maximum.accumulate(equity, axis=1) - 1.0).min(axis=1),
+            "Annual Turnover": turnover / years,
+        })
+
+    @staticmethod
+    def simulate(closes, symbols, scenarios, cost=0.0):
+        # Scenarios sharing rebalance and stop-loss settings run as one batch; only the distinct settings are looped over.
+        # Each batch runs in blocks whose scenario x day x symbol intermediates stay within SIMULATION_MAX_CELLS,
+        # and is summarized block by block, so only the equity curves are held for every scenario
+        prices = closes[list(symbols)].to_numpy(dtype=float)
+        weights = np.array([scenario["weights"] for scenario in scenarios], dtype=float).reshape(len(scenarios), len(symbols))
+        settings = [(scenario["rebalance"], scenario["stop_loss"]) for scenario in scenarios]
+        block_size = max(1, SIMULATION_MAX_CELLS // max(1, prices.size))
+        equity = np.empty((len(scenarios), len(prices)))
+        summaries = []
+        for setting in dict.fromkeys(settings):
+            indices = np.array([i for i, other in enumerate(settings) if other == setting])
+            for start in range(0, len(indices), block_size):
+                rows = indices[start:start + block_size]
+                equity[rows], rebalance_turnover = Simulator.run(prices, weights[rows], *setting, cost)
+                summaries.append(Simulator.summarize(equity[rows], rebalance_turnover.sum(axis=1), closes.index).set_axis(rows))
+        names = [scenario["name"] for scenario in scenarios]
+        summary = pd.concat(summaries).sort_index()
+        summary.index = names
+        summary.insert(0, "Rebalance", [setting[0] for setting in settings])
+        summary.insert(1, "Stop Loss", [setting[1] for setting in settings])
+        return {
+            "dates": closes.index,
+            "equity": equity,
+            "summary": summary,
+            "weights": pd.DataFrame(weights, index=names, columns=list(symbols)),
+        }
+
+    @staticmethod
+    def normalize(weights):
+        # Weights are relative: above 100% they are scaled to fully invested, below it the remainder is cash
+        weights = np.clip(np.asarray(weights, dtype=float), 0.0, None)
+        total = weights.sum()
+        return weights / total if total > 1.0 else weights
+
+    @staticmethod
+    def scenarios(symbols, current, rebalance_days=0, stop_loss=0.0, recommendations=None, custom=(), random_scenarios=0, seed=0):
+        current = np.array([current.get(symbol, 0.0) for symbol in symbols])
+        held = current > 0
+        scenarios = [{"name": "Current holdings", "weights": current, "rebalance": rebalance_days, "stop_loss": stop_loss}]
+        if rebalance_days or stop_loss:
+            scenarios.append({"name": "Current holdings, buy and hold", "weights": current, "rebalance": 0, "stop_loss": 0.0})
+        scenarios.append({"name": "Equal weight", "weights": held / max(held.sum(), 1), "rebalance": rebalance_days, "stop_loss": stop_loss})
+        sells = [symbol for symbol, action in (recommendations or {}).items() if action == "Sell" and symbol in symbols]
+        if sells:
+            scenarios.append({"name": "Follow sell recommendations", "weights": np.where(np.isin(symbols, sells), 0.0, current),
+                              "rebalance": rebalance_days, "stop_loss": stop_loss})
+        for i, scenario in enumerate(custom):
+            # Custom scenarios give explicit weights and/or symbols to sell to cash at the start
+            weights = scenario.get("weights")
+            weights = current if weights is None else Simulator.normalize([weights.get(symbol, 0.0) for symbol in symbols])
+            rebalance = scenario.get("rebalance", rebalance_days)
+            scenarios.append({
+                "name": scenario.get("name", f"Scenario {i + 1}"),
+                "weights": np.where(np.isin(symbols, list(scenario.get("sell", []))), 0.0, weights),
+                "rebalance": REBALANCE_PERIODS[rebalance] if isinstance(rebalance, str) else int(rebalance),
+                "stop_loss": float(scenario.get("stop_loss", stop_loss)),
+            })
+        if random_scenarios and held.any():
+            # Random fully invested mixes of the current holdings, drawn uniformly from the simplex
+            random_weights = np.zeros((random_scenarios, len(symbols)))
+            random_weights[:, held] = np.random.default_rng(seed).dirichlet(np.ones(held.sum()), random_scenarios)
+            scenarios.extend({"name": f"Random {i + 1:05d}", "weights": weights, "rebalance": rebalance_days, "stop_loss": stop_loss}
+                             for i, weights in enumerate(random_weights))
+        return scenarios
+
+def recommendation(analysis):
+    match = re.search(r"\b(Sell|Hold) the Stock\b", analysis or "", re.IGNORECASE)
+    return match.group(1).capitalize() if match else None
+
+@tracer.traced()
+def simulate_portfolio(portfolio_df, rebalance="quarterly", stop_loss=0.0, cost_bps=SIMULATION_COST_BPS,
+                       random_scenarios=SIMULATION_RANDOM_SCENARIOS, custom=(), recommendations=None, seed=0):
+    # Replays the current holdings and alternative weights or sell rules over the stored price history.
+    # Holdings without price history are treated as cash.
+    current = position_weights(portfolio_df)
+    wanted = list(dict.fromkeys(list(current) + [symbol for scenario in custom for symbol in scenario.get("weights") or {}]))
+    price_frames = load_price_frames(wanted)
+    symbols = [symbol for symbol in wanted if symbol in price_frames]
+    if not symbols:
+        return None
+    closes = RiskEngine.align_closes(price_frames)
+    rebalance_days = REBALANCE_PERIODS[rebalance] if isinstance(rebalance, str) else int(rebalance)
+    scenarios = Simulator.scenarios(symbols, current, rebalance_days, stop_loss, recommendations, custom, random_scenarios, seed)
+    tracer.annotate(scenarios=len(scenarios), symbols=len(symbols), days=len(closes))
+    return Simulator.simulate(closes, symbols, scenarios, cost_bps / 10000)
+
+@cache_resource
+def get_embedding_model():
+    # A missing or unusable model is cached as None, so later questions don't retry the download
+    try:
+        from fastembed import TextEmbedding
+        return TextEmbedding(model_name=EMBEDDING_MODEL, cache_dir=EMBEDDING_CACHE_DIR)
+    except Exception:
+        return None
+
+def embed_texts(texts):
+    model = get_embedding_model()
+    if model is None:
+        raise RuntimeError(f"Embedding model {EMBEDDING_MODEL} is unavailable")
+    vectors = np.array(list(model.embed(list(texts))), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@functools.lru_cache(maxsize=256)
+def embed_query(text):
+    # The domain filter and the semantic cache embed the same question; it is only computed once
+    return embed_texts([text])[0]
+
+class SemanticCache:
+    def __init__(self, path=SEMANTIC_CACHE_PATH, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, embed=None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embed = embed or embed_query
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, context TEXT, news_hash TEXT, query TEXT, "
+            "response TEXT, embedding BLOB, created_at REAL, last_access REAL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+        self.conn.commit()
+
+    def _bump(self, name):
+        self.conn.execute("INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+        self.conn.commit()
+
+    def _query_vector(self, query):
+        # The cache is shared by every session, so the vector is never memoized on the instance; embed_query is lru_cached
+        return np.asarray(self.embed(query), dtype=np.float32)
+
+    def lookup(self, query, context, news_hash):
+        # Only answers grounded in the current news snapshot can be hits
+        vector = self._query_vector(query)
+        with self._lock:
+            self.conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.ttl,))
+            rows = self.conn.execute("SELECT id, response, embedding FROM entries WHERE context = ? AND news_hash = ?", (context, news_hash)).fetchall()
+            if rows:
+                matrix = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+                similarities = matrix @ vector
+                best = int(similarities.argmax())
+                if similarities[best] >= self.threshold:
+                    self.conn.execute("UPDATE entries SET last_access = ? WHERE id = ?", (time.time(), rows[best][0]))
+                    self._bump("hits")
+                    return rows[best][1]
+            self._bump("misses")
+            return None
+
+    def store(self, query, context, news_hash, response):
+        vector = self._query_vector(query)
+        with self._lock:
+            now = time.time()
+            self.conn.execute(
+                "INSERT INTO entries (context, news_hash, query, response, embedding, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (context, news_hash, query, response, vector.tobytes(), now, now),
+            )
+            # Evict least recently used entries beyond the size limit
+            self.conn.execute(
+                "DELETE FROM entries WHERE id NOT IN (SELECT id FROM entries ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+    def invalidate_news(self, news_hash):
+        with self._lock:
+            self.conn.execute("DELETE FROM entries WHERE news_hash != ?", (news_hash,))
+            self.conn.commit()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            size = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+        lookups = hits + misses
+        return {"hits": hits, "misses": misses, "entries": size, "hit_rate": hits / lookups if lookups else 0.0}
+
+@cache_resource
+def get_semantic_cache():
+    return SemanticCache()
+
+class DomainFilter:
+    def __init__(self, embed=None, embed_many=None, accept_margin=DOMAIN_ACCEPT_MARGIN, reject_margin=DOMAIN_REJECT_MARGIN):
+        self.embed = embed or embed_query
+        embed_many = embed_many or embed_texts
+        self.finance = embed_many(FINANCE_PROTOTYPES)
+        self.off_topic = embed_many(OFF_TOPIC_PROTOTYPES)
+        self.accept_margin = accept_margin
+        self.reject_margin = reject_margin
+
+    @staticmethod
+    def keyword_match(query, symbols=()):
+        if re.search(FINANCE_KEYWORDS, query, re.IGNORECASE):
+            return True
+        return any(token in symbols for token in re.findall(r"\b[A-Z][A-Z.]{0,5}\b", query))
+
+    def margin(self, query):
+        vector = np.asarray(self.embed(query), dtype=np.float32)
+        return float((self.finance @ vector).max() - (self.off_topic @ vector).max())
+
+    def classify(self, query):
+        margin = self.margin(query)
+        tracer.annotate(domain_margin=margin)
+        if margin >= self.accept_margin:
+            return "finance"
+        if margin <= self.reject_margin:
+            return "off_topic"
+        return "ambiguous"
+
+@cache_resource
+def get_domain_filter():
+    if get_embedding_model() is None:
+        return None
+    return DomainFilter()
+
+@tracer.traced()
+def classify_query(query, portfolio_df=None):
+    # Keywords and held tickers are a fast path that skips the embedding entirely
+    symbols = set(portfolio_df['Symbol']) if portfolio_df is not None else set()
+    if not DOMAIN_FILTER or DomainFilter.keyword_match(query, symbols):
+        domain = "finance"
+    else:
+        try:
+            domain_filter = get_domain_filter()
+            # Without the embedding model nothing is rejected locally
+            domain = domain_filter.classify(query) if domain_filter is not None else "ambiguous"
+        except Exception:
+            domain = "ambiguous"
+    tracer.annotate(domain=domain)
+    return domain
+
+def guardrails_refusal(query):
+    # Only the input rails run here; a blocked message comes back replaced by the refusal
+    rails = get_guardrails()
+    if rails is None:
+        return None
+    try:
+        result = rails.generate(messages=[{"role": "user", "content": query}], options={"rails": ["input"]})
+        content = result.response[-1]["content"]
+    except Exception:
+        return None
+    return None if content == query else content
+
+def portfolio_fingerprint(portfolio_df):
+    if portfolio_df is None:
+        return "none"
+    return hashlib.sha1(pd.util.hash_pandas_object(portfolio_df, index=False).to_numpy().tobytes()).hexdigest()
+
+@cache_resource
+def get_analyzer():
+    # One Analyzer (and ChatNVIDIA client) is shared by every session in the process
+    import langchain.globals
+    langchain.globals.set_verbose(True)
+    return Analyzer()
+
+@cache_resource
+def get_guardrails():
+    if not ENABLE_GUARDRAILS:
+        return None
+    from nemoguardrails import LLMRails, RailsConfig
+    return LLMRails(RailsConfig.from_path(GUARDRAILS_CONFIG))
+
+class LLMLimiter:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, min_interval=LLM_MIN_INTERVAL, max_retries=LLM_MAX_RETRIES):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def _throttle(self):
+        # Space out request starts so bursts don't trip the endpoint's rate limit
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self, func, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            with self._semaphore:
+                self._throttle()
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if attempt == self.max_retries or not LLMLimiter.is_transient(e):
+                        raise
+            # Back off outside the semaphore so other tickers can use the slot
+            time.sleep(2 ** attempt)
+
+    @staticmethod
+    def is_transient(error):
+        # Only rate limits, server errors, timeouts and dropped connections can succeed on retry.
+        # The NVIDIA client raises HTTP errors as a plain Exception whose message starts with "[status] title".
+        if isinstance(error, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError, TimeoutError, ConnectionError)):
+            return True
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code == 429 or error.response.status_code >= 500
+        return re.match(r"\[(429|5\d\d)\]", str(error)) is not None
+
+llm_limiter = LLMLimiter()
+
+class PromptBuilder:
+    _encoding = None
+
+    @staticmethod
+    def encoding():
+        if PromptBuilder._encoding is None:
+            try:
+                import tiktoken
+                PromptBuilder._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                PromptBuilder._encoding = False
+        return PromptBuilder._encoding
+
+    @staticmethod
+    def count_tokens(text):
+        encoding = PromptBuilder.encoding()
+        if not encoding:
+            return len(text) // 4
+        return len(encoding.encode(text))
+
+    @staticmethod
+    def fit(text, section):
+        text = str(text)
+        budget = PROMPT_TOKEN_BUDGETS[section]
+        encoding = PromptBuilder.encoding()
+        if not encoding:
+            return text if len(text) <= budget * 4 else text[:budget * 4] + " ..."
+        tokens = encoding.encode(text)
+        if len(tokens) <= budget:
+            return text
+        return encoding.decode(tokens[:budget]) + " ..."
+
+    @staticmethod
+    def format_amount(value):
+        if pd.isna(value):
+            return "n/a"
+        for divisor, suffix in ((1e12, "T"), (1e9, "B"), (1e6, "M"), (1e3, "K")):
+            if abs(value) >= divisor:
+                return f"{value / divisor:.2f}{suffix}"
+        return f"{value:.2f}"
+
+    @staticmethod
+    def format_growth(current, previous):
+        if pd.isna(current) or pd.isna(previous) or previous == 0:
+            return "n/a"
+        return f"{(current - previous) / abs(previous):+.1%}"
+
+    @staticmethod
+    def statement(statements, rows):
+        # The income statement and balance sheet are concatenated and often end in different quarters,
+        # so each one is read from the columns where its own rows have data
+        statement = statements.reindex([name for _, name in rows])
+        return statement.loc[:, statement.notna().any()]
+
+    @staticmethod
+    def summarize_financials(financial_statements):
+        if not isinstance(financial_statements, pd.DataFrame) or financial_statements.empty:
+            return PromptBuilder.fit(financial_statements, "financials")
+        statements = financial_statements.loc[~financial_statements.index.duplicated()]
+        statements = statements[sorted(statements.columns, reverse=True)]
+        statements = statements.apply(pd.to_numeric, errors="coerce")
+        income = PromptBuilder.statement(statements, FINANCIAL_ROWS)
+        balance = PromptBuilder.statement(statements, BALANCE_ROWS)
+
+        lines = []
+        if not income.columns.empty:
+            lines.append(f"Latest quarter: {pd.Timestamp(income.columns[0]).date()}")
+            for label, name in FINANCIAL_ROWS:
+                values = income.loc[name].to_numpy()
+                if pd.isna(values[0]):
+                    continue
+                qoq = PromptBuilder.format_growth(values[0], values[1]) if len(values) > 1 else "n/a"
+                yoy = PromptBuilder.format_growth(values[0], values[4]) if len(values) > 4 else "n/a"
+                amount = f"{values[0]:.2f}" if name == "Diluted EPS" else PromptBuilder.format_amount(values[0])
+                lines.append(f"{label}: {amount} (QoQ {qoq}, YoY {yoy})")
+
+            latest = income.iloc[:, 0]
+            revenue = latest["Total Revenue"]
+            margins = []
+            for label, name in (("Gross", "Gross Profit"), ("Operating", "Operating Income"), ("Net", "Net Income")):
+                value = latest[name]
+                if not pd.isna(value) and not pd.isna(revenue) and revenue:
+                    margins.append(f"{label} {value / revenue:.1%}")
+            if margins:
+                lines.append("Margins: " + ", ".join(margins))
+
+        if not balance.columns.empty:
+            latest = balance.iloc[:, 0]
+            balance_parts = [f"{label} {PromptBuilder.format_amount(latest[name])}" for label, name in BALANCE_ROWS if not pd.isna(latest[name])]
+            if balance_parts:
+                lines.append(f"Balance sheet ({pd.Timestamp(balance.columns[0]).date()}): " + ", ".join(balance_parts))
+            if not pd.isna(latest["Total Debt"]) and not pd.isna(latest["Stockholders Equity"]) and latest["Stockholders Equity"]:
+                lines.append(f"Debt/Equity: {latest['Total Debt'] / latest['Stockholders Equity']:.2f}")
+        if not lines:
+            return PromptBuilder.fit(financial_statements, "financials")
+        return PromptBuilder.fit("\n".join(lines), "financials")
+
+    @staticmethod
+    def summarize_portfolio(portfolio_df):
+        if portfolio_df is None:
+            return "No portfolio uploaded."
+        columns = [column for column in PORTFOLIO_PROMPT_COLUMNS if column in portfolio_df.columns]
+        return PromptBuilder.fit(portfolio_df[columns].to_csv(index=False), "portfolio")
+
 class Analyzer:
     def __init__(self):
+        from langchain_core.output_parsers import StrOutputParser
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_nvidia_ai_endpoints import ChatNVIDIA
         self.prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("user", "{input}")])
-        self.llm = ChatNVIDIA(model="meta/llama3-70b-instruct", base_url="https://integrate.api.nvidia.com/v1", api_key=os.getenv("NVIDIA_API_KEY"))
+        self.llm = ChatNVIDIA(model=NVIDIA_MODEL, base_url=NVIDIA_BASE_URL, api_key=os.getenv("NVIDIA_API_KEY"))
         self.chain = self.prompt | self.llm | StrOutputParser()
 
-    def analyze_stock(self, ticker, stock_data, financial_statements, news):
-        input_text = (
+    @tracer.traced()
+    def stream_response(self, input_text, on_chunk=None, metrics=None):
+        # on_chunk(None) marks a (re)start so a retried call doesn't append to a partial answer
+        metrics = {} if metrics is None else metrics
+        if on_chunk:
+            on_chunk(None)
+        start = time.perf_counter()
+        first_token_at = None
+        assistant_response = ""
+        for chunk in self.chain.stream({"input": input_text}):
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            assistant_response += chunk
+            if on_chunk:
+                on_chunk(chunk)
+        end = time.perf_counter()
+        first_token_at = first_token_at or end
+        completion_tokens = PromptBuilder.count_tokens(assistant_response)
+        metrics.update({
+            "time_to_first_token": first_token_at - start,
+            "total_time": end - start,
+            "prompt_tokens": PromptBuilder.count_tokens(input_text),
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": completion_tokens / (end - first_token_at) if end > first_token_at else 0.0,
+        })
+        tracer.annotate(prompt_tokens=metrics["prompt_tokens"], completion_tokens=completion_tokens,
+                        time_to_first_token_ms=metrics["time_to_first_token"] * 1000)
+        return assistant_response
+
+    @tracer.traced()
+    def analyze_stock(self, ticker, stock_data, financial_statements, news, on_chunk=None, metrics=None):
+        tracer.annotate(ticker=ticker)
+        with tracer.span("PromptBuilder.analysis_prompt"):
+            input_text = self.analysis_prompt(ticker, stock_data, financial_statements, news)
+        return self.stream_response(input_text, on_chunk, metrics)
+
+    @staticmethod
+    def analysis_prompt(ticker, stock_data, financial_statements, news):
+        return (
             f"Analyze the stock {ticker} based on the following information:\n\n"
-            f"Stock Data: {stock_data}\n\n"
-            f"Financial Statements: {financial_statements}\n\n"
-            f"Recent News: {news}\n\n"
+            f"Stock Data: {PromptBuilder.fit(stock_data, 'stock_data')}\n\n"
+            f"Financial Statements:\n{PromptBuilder.summarize_financials(financial_statements)}\n\n"
+            f"Recent News: {PromptBuilder.fit(news, 'news')}\n\n"
             "Give a detailed stock analysis. Use the available data and provide an investment recommendation.\n\n"
             "Based on your analysis, if the stock needs to be sold, add the following line - Sell the Stock at the end of response\n\n"
             "If the stock is supposed to be held based on the analysis, add the following line - Hold the Stock at the end of response.\n\n"
             "The user is fully aware of the investment risk, so you don't need to include any kind of warning in the answer.\n\n"
             "Make sure to include only these sections: Overview - Financial Performance - Key Metrics - Valuation - Growth Prospects - Recent News - Investment Recommendation - Hold/Sell.\n\n"
-            "Please use the following example as the output format for all the tickers to maintain consistency:\n\n"
-            "Example:\n"
-            "Analysis for MICROSOFT CORP: \n"
-            "Microsoft Corporation (MSFT) is a multinational technology company that develops, manufactures, licenses, and supports a wide range of software products, services, and devices. The company is a leader in the technology industry and has a diverse product portfolio, including operating systems, productivity software, business software, and gaming consoles.\n\n"
+            "Please use the following format for all the tickers to maintain consistency:\n\n"
+            f"Analysis for {ticker}: \n"
+            "<company overview in one paragraph>\n\n"
             "Financial Performance\n"
-            "Microsoft's financial performance has been strong, with consistent revenue growth over the past few years. The company's total revenue has increased from $528.57 billion in 2023 to $618.58 billion in 2024, representing a growth rate of 17%. The gross profit margin has remained stable at around 70%, indicating a strong pricing power and cost control. The operating income has also increased from $223.52 billion in 2023 to $275.81 billion in 2024, representing a growth rate of 23%.\n\n"
+            "<revenue, margin and income trends with figures>\n\n"
             "Key Metrics : \n"
-            "- EBITDA Margin: 54.2% (higher than the industry average)\n"
-            "- Net Income Margin: 35.4% (higher than the industry average)\n"
-            "- Return on Equity (ROE): 43.5% (higher than the industry average)\n"
-            "- Debt-to-Equity Ratio: 0.65 (lower than the industry average)\n"
-            "- Interest Coverage Ratio: 15.33 (higher than the industry average)\n\n"
+            "- EBITDA Margin: <value> (<comparison with the industry average>)\n"
+            "- <further metrics in the same style>\n\n"
             "Valuation : \n"
-            "Microsoft's valuation ratios are slightly higher than the industry average, indicating a premium valuation. The forward price-to-earnings (P/E) ratio is 32.12, compared to the industry average of 25.49. The price-to-book (P/B) ratio is 11.34, compared to the industry average of 8.13.\n\n"
+            "<valuation ratios compared to the industry average>\n\n"
             "Growth Prospects\n"
-            "Microsoft has strong growth prospects, driven by its leadership in the technology industry, innovative products, and expanding presence in emerging markets. The company's cloud computing business, Azure, continues to grow rapidly, and its gaming console business is expected to benefit from the growing demand for online gaming.\n\n"
+            "<main growth drivers>\n\n"
             "Recent News : \n"
-            "There has been no significant recent news that may impact the company's stock price.\n\n"
+            "<news that may impact the stock price>\n\n"
             "Investment Recommendation : \n"
-            "Based on Microsoft's strong financial performance, attractive valuation, and growth prospects, I recommend HOLDING the stock. The company's consistent revenue growth, high margins, and strong return on equity indicate a strong underlying business. While the valuation is slightly higher than the industry average, I believe it is justified by the company's leadership in the technology industry and its growth prospects.\n\n"
+            "<recommendation with its justification>\n\n"
         )
-        assistant_response = ""
-        response_gen = self.chain.stream({"input": input_text})
-        for chunk in response_gen:
-            assistant_response += chunk
-        return assistant_response
 
-    def risk_assessment(self, ticker, stock_data):
+    @tracer.traced()
+    def risk_assessment(self, ticker, risk_report):
         try:
-            stock_returns = stock_data['Close'].pct_change().dropna()
-            volatility = stock_returns.std()
+            volatility = risk_report["assets"].loc[ticker, "Daily Volatility"]
 
             if volatility < 0.01:
                 risk_category = "Low Risk"
@@ -159,67 +1466,254 @@ class Analyzer:
         except Exception as e:
             return f"Error: Unable to calculate risk for {ticker}. {str(e)}", "gray", None
 
-def plot_stock_trend(ticker, stock_data):
-    try:
-        time_periods = {
-            "5 Years": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(years=5))],
-            "1 Year": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(years=1))],
-            "1 Month": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(months=1))],
-            "5 Days": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(days=5))]
-        }
+class ChartBuilder:
+    @staticmethod
+    def lttb(x, y, threshold):
+        # Largest-Triangle-Three-Buckets: keep the point in each bucket that forms the largest
+        # triangle with the previously kept point and the average of the next bucket
+        n = len(y)
+        if threshold >= n or threshold < 3:
+            return np.arange(n)
+        edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+        # Bucket averages are computed up front; bucket i is compared against the average of bucket i + 1
+        bounds = np.append(edges, n)
+        avg_x = np.add.reduceat(x, bounds[:-1])[1:] / np.diff(bounds)[1:]
+        avg_y = np.add.reduceat(y, bounds[:-1])[1:] / np.diff(bounds)[1:]
+        selected = np.empty(threshold, dtype=int)
+        selected[0], selected[-1] = 0, n - 1
+        a = 0
+        for i in range(threshold - 2):
+            start, end = edges[i], edges[i + 1]
+            if end - start == 1:
+                a = start
+            else:
+                area = np.abs((x[a] - avg_x[i]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[i] - y[a]))
+                a = start + int(area.argmax())
+            selected[i + 1] = a
+        return selected
 
-        fig = make_subplots(rows=1, cols=len(time_periods), subplot_titles=[f'{key}' for key in time_periods.keys()])
+    @staticmethod
+    def min_max(y, threshold):
+        # Keep the lowest and highest point of each bucket; cheaper than LTTB for very long intraday series
+        n = len(y)
+        if threshold >= n or threshold < 2:
+            return np.arange(n)
+        edges = np.linspace(0, n, threshold // 2 + 1).astype(int)
+        lows = [start + int(y[start:end].argmin()) for start, end in zip(edges[:-1], edges[1:])]
+        highs = [start + int(y[start:end].argmax()) for start, end in zip(edges[:-1], edges[1:])]
+        return np.unique(np.concatenate([[0, n - 1], lows, highs]))
 
-        for i, (period, data) in enumerate(time_periods.items()):
-            fig.add_trace(go.Scatter(x=data.index, y=data['Close'], mode='lines', name=period), row=1, col=i+1)
+    @staticmethod
+    def downsample(series, budget=CHART_POINT_BUDGET, method=CHART_DOWNSAMPLE):
+        series = series.dropna()
+        if len(series) <= budget:
+            return series
+        y = series.to_numpy(dtype="float64")
+        if method == "minmax":
+            return series.iloc[ChartBuilder.min_max(y, budget)]
+        x = series.index.asi8.astype("float64") if isinstance(series.index, pd.DatetimeIndex) else np.arange(len(series), dtype="float64")
+        return series.iloc[ChartBuilder.lttb(x, y, budget)]
 
-        fig.update_layout(title=f'{ticker} Stock Price Trends', height=400, width=1200, showlegend=False)
-        st.plotly_chart(fig)
+    @staticmethod
+    def trace(series, budget=CHART_POINT_BUDGET, **kwargs):
+        series = ChartBuilder.downsample(series, budget)
+        return {"type": "scattergl", "x": series.index, "y": series.to_numpy(), "mode": "lines", **kwargs}
 
-    except Exception as e:
-        st.write(f"Error: Unable to plot the trends for {ticker}. {str(e)}")
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def subplot_layout(titles):
+        from plotly.subplots import make_subplots
+        return make_subplots(rows=1, cols=len(titles), subplot_titles=list(titles)).layout.to_plotly_json()
 
-def plot_stock_trend_all(ticker):
-    try:
-        stock = yf.Ticker(ticker)
-        time_periods = ["5y", "1y", "6mo", "1mo", "5d"]
-        
-        fig = go.Figure()
-
-        for time_period in time_periods:
-            data = stock.history(period=time_period)
-            fig.add_trace(go.Scatter(x=data.index, y=data['Close'], mode='lines', name=f'{time_period} trend'))
-
-        fig.update_layout(
-            title=f'{ticker} Stock Price Trends',
-            xaxis_title='Date',
-            yaxis_title='Stock Price',
-            legend_title='Time Period',
-            template='plotly_white'
-        )
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def overlay_layout():
+        return go.Layout(xaxis_title='Date', yaxis_title='Stock Price', legend_title='Time Period', template='plotly_white').to_plotly_json()
 
-        st.plotly_chart(fig)
+    @staticmethod
+    def figure(data, layout):
+        # Traces are plain dicts and layouts were validated once, so per-property validation (most of the build
+        # time) is skipped. _validate is a private go.Figure argument, checked against the pinned plotly==5.22.0;
+        # if an upgrade drops it, the figure is built with validation instead.
+        try:
+            return go.Figure(data=data, layout=layout, _validate=False)
+        except TypeError:
+            return go.Figure(data=data, layout=layout)
 
-    except Exception as e:
-        st.write(f"Error: Unable to plot the trends for {ticker}. {str(e)}")
+    @staticmethod
+    def data_version(stock_data):
+        # The last close is part of the version so an updated intraday bar redraws the chart
+        return (str(stock_data.index.max()), len(stock_data), float(stock_data['Close'].iloc[-1]))
+
+# Built figures are shared read-only across reruns and sessions; st.cache_data would unpickle a copy on every hit
+chart_cache = LRUCache(maxsize=CHART_CACHE_SIZE)
+chart_cache_lock = threading.Lock()
+
+@tracer.traced(cached=True)
+def get_trend_figures(ticker, stock_data):
+    key = (ticker, ChartBuilder.data_version(stock_data))
+    with chart_cache_lock:
+        if key in chart_cache:
+            return chart_cache[key]
+    tracer.annotate(cache="miss")
+    figures = build_trend_figures(ticker, stock_data)
+    with chart_cache_lock:
+        chart_cache[key] = figures
+    return figures
+
+def build_trend_figures(ticker, stock_data):
+    time_periods = {
+        "5 Years": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(years=5))],
+        "1 Year": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(years=1))],
+        "1 Month": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(months=1))],
+        "5 Days": stock_data.loc[stock_data.index >= (stock_data.index.max() - pd.DateOffset(days=5))]
+    }
+
+    trend_traces = [
+        ChartBuilder.trace(data['Close'], CHART_POINT_BUDGET // len(time_periods), name=period,
+                           xaxis="x" if i == 0 else f"x{i + 1}", yaxis="y" if i == 0 else f"y{i + 1}")
+        for i, (period, data) in enumerate(time_periods.items())
+    ]
+    trend_layout = {**ChartBuilder.subplot_layout(tuple(time_periods)), "title": {"text": f'{ticker} Stock Price Trends'},
+                    "height": 400, "width": 1200, "showlegend": False}
+    trend_fig = ChartBuilder.figure(trend_traces, trend_layout)
+
+    overlay_traces = [
+        ChartBuilder.trace(DataFetcher.slice_period(stock_data, time_period)['Close'], name=f'{time_period} trend')
+        for time_period in ["5y", "1y", "6mo", "1mo", "5d"]
+    ]
+    overlay_layout = {**ChartBuilder.overlay_layout(), "title": {"text": f'{ticker} Stock Price Trends'}}
+    overlay_fig = ChartBuilder.figure(overlay_traces, overlay_layout)
+    return trend_fig, overlay_fig
+
+def simulation_table(result, top=SIMULATION_TOP):
+    # Named scenarios first, then the best random mixes by Sharpe ratio
+    summary = result["summary"]
+    is_random = summary.index.str.startswith("Random ")
+    return pd.concat([summary[~is_random], summary[is_random].nlargest(top, "Sharpe Ratio")])
+
+def build_simulation_figures(result, table):
+    dates = result["dates"]
+    rows = [result["summary"].index.get_loc(name) for name in table.index[:SIMULATION_TOP]]
+    equity = result["equity"][rows]
+    drawdowns = equity / np.maximum.accumulate(equity, axis=1) - 1.0
+    budget = CHART_POINT_BUDGET // 2
+    layout = {**ChartBuilder.subplot_layout(("Equity", "Drawdown")), "height": 400, "template": "plotly_white"}
+    traces = []
+    for i, name in enumerate(table.index[:SIMULATION_TOP]):
+        color = f"hsl({i * 360 // SIMULATION_TOP}, 60%, 45%)"
+        traces.append(ChartBuilder.trace(pd.Series(equity[i], index=dates), budget, name=name, legendgroup=name, line={"color": color}))
+        traces.append(ChartBuilder.trace(pd.Series(drawdowns[i], index=dates), budget, name=name, legendgroup=name, showlegend=False,
+                                         line={"color": color}, xaxis="x2", yaxis="y2"))
+    curves_fig = ChartBuilder.figure(traces, layout)
+
+    summary = result["summary"]
+    scatter = {"type": "scattergl", "x": summary["Annualized Volatility"].to_numpy(), "y": summary["CAGR"].to_numpy(),
+               "mode": "markers", "text": summary.index.to_numpy(), "marker": {"size": 4, "color": summary["Sharpe Ratio"].to_numpy(),
+               "colorscale": "Viridis", "showscale": True, "colorbar": {"title": {"text": "Sharpe"}}}}
+    scatter_layout = {"title": {"text": "Scenarios: annualized volatility vs CAGR"}, "xaxis": {"title": {"text": "Volatility"}, "tickformat": ".0%"},
+                      "yaxis": {"title": {"text": "CAGR"}, "tickformat": ".0%"}, "height": 400, "template": "plotly_white"}
+    return curves_fig, ChartBuilder.figure([scatter], scatter_layout)
+
+@st.experimental_fragment
+def simulation_panel():
+    # Form inputs only rerun this fragment when the simulation is submitted
+    portfolio_df = st.session_state.portfolio_df
+    with st.expander("What-if simulation over the price history"):
+        with st.form("simulation_form"):
+            cols = st.columns(4)
+            rebalance = cols[0].selectbox("Rebalance", list(REBALANCE_PERIODS), index=2, format_func=lambda period: "Buy and hold" if period == "none" else period.capitalize())
+            stop_loss = cols[1].slider("Trailing stop-loss (%)", 0, 50, 0, step=5)
+            random_scenarios = cols[2].number_input("Random weight scenarios", 0, 20000, SIMULATION_RANDOM_SCENARIOS, step=500)
+            cost_bps = cols[3].number_input("Trading cost (bps)", 0.0, 100.0, SIMULATION_COST_BPS)
+            sells = st.multiselect("Sell at the start", list(dict.fromkeys(portfolio_df['Symbol'])))
+            submitted = st.form_submit_button("Run simulation")
+        if submitted:
+            recommendations = {ticker: recommendation(analysis) for ticker, analysis in st.session_state.analysis_results.items()}
+            custom = [{"name": f"Sell {', '.join(sells)}", "sell": sells}] if sells else []
+            with st.spinner("Simulating..."):
+                result = simulate_portfolio(portfolio_df, rebalance, stop_loss / 100, cost_bps, int(random_scenarios), custom, recommendations)
+            if result is None:
+                st.session_state.simulation = None
+                st.write("Error: Unable to simulate the portfolio. No price history is available for the holdings.")
+                return
+            table = simulation_table(result)
+            st.session_state.simulation = (table, build_simulation_figures(result, table), len(result["summary"]), result["dates"])
+        if st.session_state.simulation is not None:
+            table, figures, count, dates = st.session_state.simulation
+            st.caption(f"{count} scenarios from {dates[0]:%Y-%m-%d} to {dates[-1]:%Y-%m-%d}")
+            percent_columns = ["Stop Loss", "Total Return", "CAGR", "Annualized Volatility", "Max Drawdown", "Annual Turnover"]
+            st.dataframe(table.style.format({**{column: "{:.2%}" for column in percent_columns}, "Sharpe Ratio": "{:.2f}"}))
+            for fig in figures:
+                st.plotly_chart(fig, use_container_width=True)
 
 def handle_user_input():
     query = st.session_state["follow_up_query"]
     if query:
-        with st.spinner('Generating response...'):
-            response = answer_follow_up_question(query)
-            st.session_state.conversation.append({"query": query, "response": response})
+        # The answer is streamed by chat_panel(), after the existing conversation
+        st.session_state.pending_query = query
         st.session_state["follow_up_query"] = ""  # Clear input box
 
-def answer_follow_up_question(query):
+def stream_pending_answer():
+    query = st.session_state.pending_query
+    if not query:
+        return
+    st.session_state.pending_query = None
+    st.markdown(user_message_html(query), unsafe_allow_html=True)
+    placeholder = st.empty()
+    streamed = []
+
+    def on_chunk(chunk):
+        if chunk is None:
+            streamed.clear()
+            return
+        streamed.append(chunk)
+        placeholder.markdown(ai_message_html("".join(streamed)), unsafe_allow_html=True)
+
+    metrics = {"call": "follow_up"}
+    response = answer_follow_up_question(query, on_chunk=on_chunk, metrics=metrics)
+    placeholder.markdown(ai_message_html(response), unsafe_allow_html=True)
+    st.markdown('<div class="message-divider"></div>', unsafe_allow_html=True)
+    st.session_state.conversation.append({"query": query, "response": response})
+    st.session_state.conversation_html += message_pair_html(query, response)
+    if "total_time" in metrics:
+        st.session_state.llm_metrics.append(metrics)
+
+@tracer.traced(cached=True)
+def answer_follow_up_question(query, on_chunk=None, metrics=None):
+    # Off-topic questions are refused locally; only ambiguous ones go through the guardrails input check
+    domain = classify_query(query, st.session_state.get('portfolio_df'))
+    refusal = DOMAIN_REFUSAL if domain == "off_topic" else guardrails_refusal(query) if domain == "ambiguous" else None
+    if refusal is not None:
+        tracer.annotate(cache=None, domain=domain)
+        if on_chunk:
+            on_chunk(refusal)
+        return refusal
+
+    # Near-duplicate questions about the same portfolio and news snapshot are answered from the semantic cache
+    context = portfolio_fingerprint(st.session_state.get('portfolio_df'))
     news = DataFetcher.get_recent_stock_news("stock")
+    news_hash = hashlib.sha1(news.encode()).hexdigest()
+    try:
+        cache = get_semantic_cache()
+        with tracer.span("SemanticCache.lookup"):
+            cached_response = cache.lookup(query, context, news_hash)
+    except Exception:
+        cache, cached_response = None, None
+    if cached_response is None:
+        tracer.annotate(cache="miss")
+    else:
+        if on_chunk:
+            on_chunk(cached_response)
+        return cached_response
+
     input_text = (
         f"If the query is not related to finance or investment, strictly respond with the message: "
         f"I'm sorry, but I can only provide information related to finance and stocks.\n\n"
         f"Query: {query}\n\n"
         f"Otherwise, based on the following query, provide a detailed response:\n\n{query}\n\n and strictly don't include anything from news and portfolio unless relevant"
-        f"If the query is related to current/recent news only then include the following:\nRecent News: {news}\n\n"
-        f"If the query is related to the portfolio stocks only then refer to the following data:\n{st.session_state.get('portfolio_df')}\n\n"
+        f"If the query is related to current/recent news only then include the following:\nRecent News: {PromptBuilder.fit(news, 'news')}\n\n"
+        f"If the query is related to the portfolio stocks only then refer to the following data:\n{PromptBuilder.summarize_portfolio(st.session_state.get('portfolio_df'))}\n\n"
         f"Use your knowledge, the available data, and the recent news (if applicable) to provide a precise and intuitive response.\n\n"
         f"Use these examples to understand the context and how the question should be answered:\n\n"
         "EXAMPLE 1:\n"
@@ -250,15 +1744,40 @@ def answer_follow_up_question(query):
         "10. Home Depot (HD) - The home improvement retailer reported robust sales, driven by increased spending on home renovations and construction.\n"
     )
 
-    assistant_response = ""
-    response_gen = analyzer.chain.stream({"input": input_text})
-    for chunk in response_gen:
-        assistant_response += chunk
+    assistant_response = get_analyzer().stream_response(input_text, on_chunk, metrics)
+
+    if cache is not None:
+        # Answers grounded in an older news snapshot are dropped once the headlines change
+        cache.invalidate_news(news_hash)
+        cache.store(query, context, news_hash, assistant_response)
     return assistant_response
 
+def display_cache_stats():
+    try:
+        stats = get_semantic_cache().stats()
+    except Exception:
+        return
+    st.caption(f"Answer cache hit rate: {stats['hit_rate']:.0%} ({stats['hits']} of {stats['hits'] + stats['misses']} questions, {stats['entries']} cached)")
+
+@st.experimental_fragment
+def display_trace_panel():
+    # Shown with DEBUG_PANEL=1 or ?debug=1 in the page URL
+    if not (DEBUG_PANEL or st.query_params.get("debug") == "1"):
+        return
+    with st.expander("Trace spans"):
+        st.button("Refresh", key="refresh_trace_panel")
+        summary = tracer.summary()
+        if summary.empty:
+            st.caption("No spans recorded yet.")
+            return
+        st.dataframe(summary, use_container_width=True)
+        st.dataframe(pd.DataFrame(list(tracer.spans)[-50:][::-1]), use_container_width=True, hide_index=True)
+        st.download_button("Download spans (JSON lines)", tracer.to_jsonl(), file_name="spans.jsonl", mime="application/x-ndjson")
+        st.download_button("Download metrics (Prometheus)", tracer.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+
 def display_conversation():
-    conversation = st.session_state.conversation
-    st.sidebar.markdown(
+    # Past messages are kept as one HTML string, so each rerun emits a single element however long the chat gets
+    st.markdown(
         """
         <style>
         .chat-message {
@@ -281,59 +1800,219 @@ def display_conversation():
             margin: 10px 0;
         }
         </style>
-        """, 
+        """ + st.session_state.conversation_html,
         unsafe_allow_html=True
     )
-    for message in conversation:
-        user_message_html = f"""
+
+@st.experimental_fragment
+def chat_panel():
+    # Submitting a question reruns only this fragment: the history is one element and the new answer is streamed below it
+    display_conversation()
+    stream_pending_answer()
+    st.text_input(" ", key="follow_up_query", on_change=handle_user_input, placeholder="Type your question here...")
+    display_cache_stats()
+    if DOMAIN_FILTER and get_domain_filter() is None:
+        st.caption(f"Local topic filter is off: embedding model {EMBEDDING_MODEL} is unavailable.")
+
+def user_message_html(query):
+    return f"""
         <div class="chat-message user-message">
-            <strong>You:</strong> {message['query']}
+            <strong>You:</strong> {query}
         </div>
         """
-        ai_message_html = f"""
+
+def ai_message_html(response):
+    return f"""
         <div class="chat-message ai-message">
-            <strong>AI:</strong> {message['response']}
+            <strong>AI:</strong> {response}
         </div>
         """
-        st.sidebar.markdown(user_message_html, unsafe_allow_html=True)
-        st.sidebar.markdown(ai_message_html, unsafe_allow_html=True)
-        st.sidebar.markdown('<div class="message-divider"></div>', unsafe_allow_html=True)
 
-def analyze_portfolio():
-    portfolio_df = st.session_state.portfolio_df
-    for index, row in portfolio_df.iterrows():
-        ticker = row['Symbol']
-        stock_data, stock_summary = DataFetcher.get_stock_data(ticker)
-        financial_statements = DataFetcher.get_financial_statements(ticker)
-        news = DataFetcher.get_recent_stock_news(ticker)
-        with st.spinner('Generating analysis...'):
-            analysis = analyzer.analyze_stock(ticker, stock_summary, financial_statements, news)
-        st.session_state.analysis_results[ticker] = analysis
-
-def performance_analysis(row):
-    total_gain_loss = row["Total Gain/Loss Dollar"]
-    percentage_gain_loss = row["Total Gain/Loss Percent"]
-    todays_gain_loss_dollar = row["Today's Gain/Loss Dollar"]
-    todays_gain_loss_percent = row["Today's Gain/Loss Percent"]
-    percent_of_account = row["Percent Of Account"]
-    average_cost_basis = row["Average Cost Basis"]
-    current_price = row["Last Price"]
-    total_gain_loss_percent = row["Total Gain/Loss Percent"]
+def message_pair_html(query, response):
+    return user_message_html(query) + ai_message_html(response) + '<div class="message-divider"></div>'
+
+def fetch_ticker_inputs(ticker):
+    stock_data, stock_summary = DataFetcher.get_stock_data(ticker)
+    financial_statements = DataFetcher.get_financial_statements(ticker)
+    news = DataFetcher.get_recent_stock_news(ticker)
+    price_date = stock_data.index[-1].date() if stock_data is not None and not stock_data.empty else None
+    return stock_summary, financial_statements, news, price_date
+
+def content_hash(*values):
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, pd.DataFrame):
+            digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+            digest.update(str(list(value.columns)).encode())
+        else:
+            digest.update(str(value).encode())
+    return digest.hexdigest()
+
+def position_fields(portfolio_df):
+    # One tuple of position values per symbol, covering every account that holds it
+    columns = [column for column in FINGERPRINT_POSITION_FIELDS if column in portfolio_df.columns]
+    values = portfolio_df[columns].astype("float64").round(6)
+    return {symbol: tuple(map(tuple, group.to_numpy().tolist())) for symbol, group in values.groupby(portfolio_df["Symbol"], sort=False)}
+
+def analysis_fingerprint(price_date, financial_statements, news, position=None):
+    # Intraday price moves keep the fingerprint; a new bar, new statements, new headlines or a changed position don't
+    return content_hash(price_date, financial_statements, news, position)
+
+@tracer.traced(cached=True)
+def generate_analysis(analyzer, limiter, ticker, stock_summary, financial_statements, news, fingerprint, on_chunk=None, metrics=None):
+    generate = functools.partial(limiter.run, analyzer.analyze_stock, ticker, stock_summary, financial_statements, news, on_chunk=on_chunk, metrics=metrics)
+    if isinstance(financial_statements, tuple) or str(stock_summary).startswith("Error") or str(news).startswith("Error"):
+        # Analyses written without part of their inputs are not shared
+        tracer.annotate(cache="miss")
+        return generate()
+    # Analyses are stored under the ticker's fingerprint, so re-uploads and other sessions or replicas only
+    # call the LLM for tickers whose inputs changed, and concurrent callers wait for one generation
+    analysis = shared_cache.get_or_fetch("analyses", f"{ticker}:{fingerprint}", generate)
+    if metrics is not None and "total_time" not in metrics:
+        metrics["reused"] = True
+    return analysis
 
+def iter_portfolio_analysis(analyzer, tickers, limiter=None, fetch_workers=FETCH_MAX_WORKERS, on_chunk=None, positions=None):
+    # Fetches run in one pool, LLM calls in a second pool gated by the limiter,
+    # and each ticker is yielded as soon as its analysis is ready.
+    # on_chunk(ticker, chunk) receives streamed tokens from the worker threads.
+    # positions maps tickers to their position_fields() entry for the fingerprint.
+    limiter = limiter or llm_limiter
+    positions = positions or {}
+    ctx = get_script_run_ctx()
+
+    def attach_ctx():
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    metrics = {}
+    with ThreadPoolExecutor(max_workers=fetch_workers, initializer=attach_ctx) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=limiter.max_concurrency, initializer=attach_ctx) as llm_pool:
+        pending = {fetch_pool.submit(fetch_ticker_inputs, ticker): ("fetch", ticker) for ticker in tickers}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, ticker = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield ticker, f"Error: Unable to generate analysis for {ticker}. {str(e)}", metrics.get(ticker, {})
+                    continue
+                if stage == "fetch":
+                    stock_summary, financial_statements, news, price_date = result
+                    fingerprint = analysis_fingerprint(price_date, financial_statements, news, positions.get(ticker))
+                    metrics[ticker] = {"call": f"analysis:{ticker}", "fingerprint": fingerprint}
+                    ticker_on_chunk = (lambda chunk, ticker=ticker: on_chunk(ticker, chunk)) if on_chunk else None
+                    llm_future = llm_pool.submit(generate_analysis, analyzer, limiter, ticker, stock_summary, financial_statements, news,
+                                                 fingerprint, on_chunk=ticker_on_chunk, metrics=metrics[ticker])
+                    pending[llm_future] = ("llm", ticker)
+                else:
+                    yield ticker, result, metrics[ticker]
+
+@tracer.traced()
+def analyze_portfolio(portfolio_df):
+    tickers = list(dict.fromkeys(portfolio_df['Symbol'].tolist()))
+    DataFetcher.prefetch_stock_data(tickers + [RISK_BENCHMARK])
+    context = view_model_context(portfolio_df)
+    progress = st.progress(0.0, text='Generating analysis...')
+    stream_slot = st.empty()
+    stream_area = stream_slot.container()
+    placeholders = {}
+    streamed = defaultdict(str)
+    events = queue.Queue()
+
+    def run_pipeline():
+        try:
+            for ticker, analysis, metrics in iter_portfolio_analysis(get_analyzer(), tickers, on_chunk=lambda ticker, chunk: events.put(("chunk", ticker, chunk)),
+                                                                     positions=position_fields(portfolio_df)):
+                events.put(("done", ticker, (analysis, metrics)))
+        except Exception as e:
+            # Raised here the error would only end the thread; the script thread reports it
+            events.put(("error", None, e))
+        finally:
+            events.put(("finished", None, None))
+
+    # Worker threads only enqueue events; all Streamlit calls stay on the script thread
+    worker = threading.Thread(target=run_pipeline, daemon=True)
+    add_script_run_ctx(worker, get_script_run_ctx())
+    worker.start()
+    completed = 0
+    finished = False
+    error = None
+    while not finished:
+        # Drain everything queued since the last redraw so each ticker is redrawn once per batch
+        batch = [events.get()]
+        while not events.empty():
+            batch.append(events.get_nowait())
+        dirty = set()
+        completed_tickers = []
+        for kind, ticker, payload in batch:
+            if kind == "finished":
+                finished = True
+                continue
+            if kind == "error":
+                error = payload
+                continue
+            if ticker not in placeholders:
+                placeholders[ticker] = stream_area.expander(f"Analysis for {ticker}", expanded=not placeholders).empty()
+            if kind == "chunk":
+                streamed[ticker] = "" if payload is None else streamed[ticker] + payload
+                dirty.add(ticker)
+                continue
+            analysis, metrics = payload
+            completed += 1
+            st.session_state.analysis_results[ticker] = analysis
+            if "total_time" in metrics:
+                st.session_state.analysis_metrics[ticker] = metrics
+                st.session_state.llm_metrics.append(metrics)
+            elif metrics.get("reused"):
+                st.session_state.analysis_metrics[ticker] = metrics
+            else:
+                st.session_state.analysis_metrics.pop(ticker, None)
+            streamed[ticker] = analysis
+            dirty.add(ticker)
+            completed_tickers.append(ticker)
+            progress.progress(completed / len(tickers), text=f'Generated analysis for {ticker} ({completed}/{len(tickers)})')
+        for ticker in dirty:
+            placeholders[ticker].markdown(streamed[ticker])
+        # View models are built while the remaining tickers are still streaming
+        build_view_models(portfolio_df, completed_tickers, context)
+    worker.join()
+    progress.empty()
+    stream_slot.empty()
+    if error is not None:
+        st.error(f"Error: Unable to finish the portfolio analysis ({completed}/{len(tickers)} tickers done). {str(error)}")
+        st.exception(error)
+
+def format_money(values):
+    values = values.astype("float64")
+    return values.map(lambda value: f"-${abs(value):,.2f}" if value < 0 else f"${value:,.2f}").where(values.notna(), "n/a")
+
+def format_percent(values):
+    values = values.astype("float64")
+    return values.map("{:.2f}%".format).where(values.notna(), "n/a")
+
+def performance_analysis(portfolio_df):
+    # Builds the performance markdown for every holding at once, one column operation per field
     analysis = (
-        f"\n"
-        f"\n### Performance Analysis\n\n"
-        f"- Total Gain/Loss: {total_gain_loss}\n\n"
-        f"- Percentage Gain/Loss: {percentage_gain_loss}%\n\n"
-        f"- Today's Gain/Loss: {todays_gain_loss_dollar} ({todays_gain_loss_percent}%)\n\n"
-        f"\n### Allocation Analysis\n\n"
-        f"- Percent of Account: {percent_of_account}%\n\n"
-        f"\n### Cost Basis Analysis\n\n"
-        f"- Average Cost Basis: {average_cost_basis}\n\n"
-        f"- Current Price: {current_price}\n\n"
-        f"- Total Gain/Loss Percent: {total_gain_loss_percent}%\n\n"
+        "\n"
+        + "\n### Performance Analysis\n\n"
+        + "- Total Gain/Loss: " + format_money(portfolio_df["Total Gain/Loss Dollar"]) + "\n\n"
+        + "- Percentage Gain/Loss: " + format_percent(portfolio_df["Total Gain/Loss Percent"]) + "\n\n"
+        + "- Today's Gain/Loss: " + format_money(portfolio_df["Today's Gain/Loss Dollar"]) + " (" + format_percent(portfolio_df["Today's Gain/Loss Percent"]) + ")\n\n"
+        + "\n### Allocation Analysis\n\n"
+        + "- Percent of Account: " + format_percent(portfolio_df["Percent Of Account"]) + "\n\n"
+        + "\n### Cost Basis Analysis\n\n"
+        + "- Average Cost Basis: " + format_money(portfolio_df["Average Cost Basis"]) + "\n\n"
+        + "- Current Price: " + format_money(portfolio_df["Last Price"]) + "\n\n"
+        + "- Total Gain/Loss Percent: " + format_percent(portfolio_df["Total Gain/Loss Percent"]) + "\n\n"
     )
-
+    # A symbol held in several accounts gets one block per account, each headed by the account
+    accounts = [column for column in ("Account Name", "Account Number") if column in portfolio_df.columns]
+    if accounts:
+        repeated = portfolio_df["Symbol"].duplicated(keep=False).to_numpy()
+        label = portfolio_df[accounts].astype("string").fillna("").agg(" ".join, axis=1).str.strip()
+        analysis = analysis.where(~repeated, "\n#### Account " + label + "\n" + analysis)
+    analysis.index = portfolio_df["Symbol"]
     return analysis
 
 def format_analysis(analysis):
@@ -348,37 +2027,128 @@ def format_analysis(analysis):
 
     return "\n\n".join(formatted_sections)
 
+def risk_badge_html(risk_category, color, volatility):
+    volatility_text = f" (Volatility: {volatility:.4f})" if volatility is not None else ""
+    return f"""
+        <button style="background-color:{color}; color:white; border:none; padding:10px 20px; cursor:pointer;">
+            {risk_category}{volatility_text}
+        </button>
+        """
+
+def risk_details_markdown(ticker, risk_report):
+    metrics = risk_report["assets"].loc[ticker]
+    portfolio = risk_report["portfolio"]
+    return (
+        f"- Annualized Volatility: {metrics['Annualized Volatility']:.2%} ({ROLLING_WINDOW}-day: {metrics['Rolling Volatility']:.2%})\n"
+        f"- Beta vs {risk_report['benchmark']}: {metrics['Beta']:.2f}\n"
+        f"- Max Drawdown: {metrics['Max Drawdown']:.2%}\n"
+        f"- 1-Day {VAR_CONFIDENCE:.0%} VaR: {metrics['Historical VaR']:.2%} historical, {metrics['Parametric VaR']:.2%} parametric\n"
+        f"- Portfolio: {portfolio['Annualized Volatility']:.2%} annualized volatility, beta {portfolio['Beta']:.2f}, "
+        f"max drawdown {portfolio['Max Drawdown']:.2%}, 1-day VaR {portfolio['Historical VaR']:.2%}"
+    )
+
+def build_view_model(ticker, performance, risk_report, analyzer):
+    metrics = st.session_state.analysis_metrics.get(ticker)
+    view = {
+        "analysis": format_analysis(st.session_state.analysis_results[ticker]),
+        "caption": None,
+        "performance": f"<div style='color: green;'>{performance}</div>",
+        "figures": [],
+        "chart_error": None,
+        "risk_details": None,
+    }
+    if metrics and metrics.get("reused"):
+        view["caption"] = "Reused the stored analysis; the price date, statements, news and position are unchanged"
+    elif metrics:
+        view["caption"] = (
+            f"Generated in {metrics['total_time']:.1f}s (first token after {metrics['time_to_first_token']:.2f}s, "
+            f"{metrics['completion_tokens']} tokens at {metrics['tokens_per_second']:.1f} tokens/s)"
+        )
+    try:
+        stock_data, _ = DataFetcher.get_stock_data(ticker)
+        view["figures"] = list(get_trend_figures(ticker, stock_data))
+    except Exception as e:
+        view["chart_error"] = f"Error: Unable to plot the trends for {ticker}. {str(e)}"
+    risk_category, color, volatility = analyzer.risk_assessment(ticker, risk_report)
+    view["risk_badge"] = risk_badge_html(risk_category, color, volatility)
+    if volatility is not None:
+        view["risk_details"] = risk_details_markdown(ticker, risk_report)
+    return view
+
+def view_model_context(portfolio_df):
+    return performance_analysis(portfolio_df), get_portfolio_risk(portfolio_df), get_analyzer()
+
+@tracer.traced()
+def build_view_models(portfolio_df, tickers, context=None):
+    # Everything the ticker panel shows is built once here, so switching tickers only replays stored elements
+    performance, risk_report, analyzer = context or view_model_context(portfolio_df)
+    for ticker in tickers:
+        if ticker in st.session_state.analysis_results:
+            st.session_state.view_models[ticker] = build_view_model(ticker, "".join(performance.loc[[ticker]]), risk_report, analyzer)
+
+@tracer.traced()
 def display_analysis_results(ticker):
     if ticker in st.session_state.analysis_results:
-        analysis = st.session_state.analysis_results[ticker]
+        if ticker not in st.session_state.view_models:
+            build_view_models(st.session_state.portfolio_df, [ticker])
+        view = st.session_state.view_models[ticker]
         st.write(f"**Analysis for {ticker}:**")
-        formatted_analysis = format_analysis(analysis)
-        st.markdown(formatted_analysis)
+        st.markdown(view["analysis"])
+        if view["caption"]:
+            st.caption(view["caption"])
         st.write("---")
 
-        row = st.session_state.portfolio_df[st.session_state.portfolio_df['Symbol'] == ticker].iloc[0]
-        additional_analysis = performance_analysis(row)
-        green_analysis = f"<div style='color: green;'>{additional_analysis}</div>"
-        st.markdown(green_analysis, unsafe_allow_html=True)
+        st.markdown(view["performance"], unsafe_allow_html=True)
         st.write("---")
 
-        stock_data, _ = DataFetcher.get_stock_data(ticker)
-        plot_stock_trend(ticker, stock_data)
-        plot_stock_trend_all(ticker)
+        for fig in view["figures"]:
+            st.plotly_chart(fig)
+        if view["chart_error"]:
+            st.write(view["chart_error"])
         st.write(f"**Risk Assessment for {ticker}:**")
-        risk_category, color, volatility = analyzer.risk_assessment(ticker, stock_data)
-
-        button_html = f"""
-        <button style="background-color:{color}; color:white; border:none; padding:10px 20px; cursor:pointer;">
-            {risk_category} (Volatility: {volatility:.4f})
-        </button>
-        """
-        st.markdown(button_html, unsafe_allow_html=True)
+        st.markdown(view["risk_badge"], unsafe_allow_html=True)
+        if view["risk_details"]:
+            st.markdown(view["risk_details"])
         st.write("---")
 
+@st.experimental_fragment
+def ticker_panel():
+    # A ticker click reruns only this fragment
+    tickers = list(dict.fromkeys(st.session_state.portfolio_df['Symbol'].tolist()))
+    if st.session_state.selected_stock not in tickers:
+        st.session_state.selected_stock = tickers[0]
+
+    cols = st.columns(len(tickers))
+    for i, ticker in enumerate(tickers):
+        if cols[i].button(ticker, key=ticker, use_container_width=True):
+            st.markdown(f"""
+            <style>
+            .stButton button {{
+                background-color: #000000;
+                color: white;
+                border: none;
+                padding: 10px 20px;
+                font-size: 16px;
+                border-radius: 5px;
+                cursor: pointer;
+            }}
+            .stButton button:hover {{
+                background-color: #76B900;
+            }}
+            </style>
+            """, unsafe_allow_html=True)
+            st.session_state.selected_stock = ticker
+
+    display_analysis_results(st.session_state.selected_stock)
+
 # Existing code for main function and other functionalities
 def main():
     st.set_page_config(page_title="Personal Financial Stock Analyzer", layout="wide")
+    init_session_state()
+    get_guardrails()
+    # The embedding model is loaded (or found missing) once per process here rather than on the first question
+    if DOMAIN_FILTER:
+        get_domain_filter()
     st.markdown(
         """
         <style>
@@ -437,46 +2207,26 @@ def main():
     st.markdown('<div class="main-title">Personal Financial Stock Analyzer</div>', unsafe_allow_html=True)
 
     uploaded_file = st.file_uploader("Upload your stock portfolio CSV file", type="csv")
-    if uploaded_file is not None:
-        st.session_state.portfolio_df = pd.read_csv(uploaded_file)
+    # The uploader keeps returning the same file on every rerun; only a new upload is ingested and analyzed
+    if uploaded_file is not None and uploaded_file.file_id != st.session_state.portfolio_file_id:
+        st.session_state.portfolio_file_id = uploaded_file.file_id
+        st.session_state.portfolio_df = PositionLoader.load(uploaded_file)
         st.session_state.portfolio_analysis_done = False
+        st.session_state.view_models = {}
+        st.session_state.simulation = None
 
     if st.session_state.portfolio_df is not None and not st.session_state.portfolio_analysis_done:
-        analyze_portfolio()
+        analyze_portfolio(st.session_state.portfolio_df)
         st.session_state.portfolio_analysis_done = True
 
     if st.session_state.portfolio_df is not None:
-        tickers = st.session_state.portfolio_df['Symbol'].tolist()
-        if st.session_state.selected_stock is None:
-            st.session_state.selected_stock = tickers[0]
-
-        cols = st.columns(len(tickers))
-        for i, ticker in enumerate(tickers):
-            if cols[i].button(ticker, key=ticker, use_container_width=True):
-                st.markdown(f"""
-                <style>
-                .stButton button {{
-                    background-color: #000000;
-                    color: white;
-                    border: none;
-                    padding: 10px 20px;
-                    font-size: 16px;
-                    border-radius: 5px;
-                    cursor: pointer;
-                }}
-                .stButton button:hover {{
-                    background-color: #76B900;
-                }}
-                </style>
-                """, unsafe_allow_html=True)
-                st.session_state.selected_stock = ticker
-
-        display_analysis_results(st.session_state.selected_stock)
-
-    st.sidebar.markdown('<div class="sidebar-title">Learn More About Investment:</div>', unsafe_allow_html=True)
-    display_conversation()
-    user_query = st.sidebar.text_input(" ", key="follow_up_query", on_change=handle_user_input, placeholder="Type your question here...")
+        ticker_panel()
+        simulation_panel()
+
+    with st.sidebar:
+        st.markdown('<div class="sidebar-title">Learn More About Investment:</div>', unsafe_allow_html=True)
+        chat_panel()
+        display_trace_panel()
 
 if __name__ == "__main__":
-    analyzer = Analyzer()
     main()
@@ -0,0 +1,32 @@
+import logging
+import pandas as pd
+import nim
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+def quarters(*dates):
+    return [pd.Timestamp(date) for date in dates]
+
+def test_statements_ending_in_different_quarters():
+    # The balance sheet already has the June quarter while the income statement ends in March
+    income = pd.DataFrame(
+        [[120.0, 100.0, 90.0, 85.0, 80.0], [60.0, 50.0, 45.0, 40.0, 40.0], [30.0, 20.0, 18.0, 17.0, 16.0]],
+        index=["Total Revenue", "Gross Profit", "Net Income"],
+        columns=quarters("2024-03-31", "2023-12-31", "2023-09-30", "2023-06-30", "2023-03-31"),
+    )
+    balance = pd.DataFrame(
+        [[50.0, 40.0], [200.0, 180.0], [25.0, 20.0]],
+        index=["Total Debt", "Stockholders Equity", "Cash And Cash Equivalents"],
+        columns=quarters("2024-06-30", "2024-03-31"),
+    )
+    summary = nim.PromptBuilder.summarize_financials(pd.concat([income, balance]))
+    lines = summary.splitlines()
+    assert lines[0] == "Latest quarter: 2024-03-31"
+    assert "Revenue: 120.00 (QoQ +20.0%, YoY +50.0%)" in lines
+    assert "Net Income: 30.00 (QoQ +50.0%, YoY +87.5%)" in lines
+    assert "Margins: Gross 50.0%, Net 25.0%" in lines
+    assert "Balance sheet (2024-06-30): Total Debt 50.00, Cash 25.00, Equity 200.00" in lines
+    assert "Debt/Equity: 0.25" in lines
+
+def test_statement_errors_are_passed_through():
+    assert nim.PromptBuilder.summarize_financials((None, "Error: Unable to retrieve")).startswith("(None")
@@ -0,0 +1,32 @@
+import os
+import re
+import logging
+import types
+import nim
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fixtures", "google_news.html")
+
+def fixture_html():
+    with open(FIXTURE, "rb") as f:
+        return f.read()
+
+def test_parse_extracts_headline_titles():
+    news = nim.NewsFetcher.parse(fixture_html())
+    assert news[:3] == [
+        "Chipmakers rally as AI demand lifts semiconductor outlook",
+        "Fed holds rates steady, signals patience on cuts",
+        "Tech giants report record cloud revenue",
+    ]
+    assert news[8:] == ["Semiconductor ETF hits all-time high", "Treasury yields edge lower after jobs report"]
+    # Snippets, timestamps and the source links around each headline are left out
+    assert not any(re.search(r"hours ago|https?://|\.example|^link$", title) for title in news)
+
+def test_download_formats_the_parsed_headlines():
+    response = types.SimpleNamespace(content=fixture_html(), raise_for_status=lambda: None)
+    session = types.SimpleNamespace(get=lambda url, timeout: response)
+    news = nim.NewsFetcher(session=session).download("NVDA")
+    lines = news.splitlines()
+    assert lines[:3] == ["Recent News:", "", "1. Chipmakers rally as AI demand lifts semiconductor outlook"]
+    assert lines[-1] == "10. Treasury yields edge lower after jobs report"
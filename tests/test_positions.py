@@ -0,0 +1,43 @@
+import io
+import logging
+import pytest
+import nim
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+# Fidelity-style export: data rows end with a trailing comma, each account has a money-market core position,
+# one has pending activity, and the file ends with a disclaimer footer
+FIDELITY_CSV = """﻿Account Number,Account Name,Symbol,Description,Quantity,Last Price,Last Price Change,Current Value,Today's Gain/Loss Dollar,Today's Gain/Loss Percent,Total Gain/Loss Dollar,Total Gain/Loss Percent,Percent Of Account,Cost Basis Total,Average Cost Basis,Type
+X1,Individual,SPAXX**,HELD IN MONEY MARKET,,,,$500.00,,,,,20.00%,,,Cash,
+X1,Individual,NVDA,NVIDIA CORPORATION COM,10,$125.00,+$1.50,"$1,250.00",+$15.00,+1.21%,+$250.00,+25.00%,50.00%,"$1,000.00",$100.00,Cash,
+X1,Individual,MSFT,MICROSOFT CORP,2,$375.00,-$2.00,$750.00,-$4.00,-0.53%,($50.00),(6.25%),30.00%,$800.00,$400.00,Cash,
+X2,Roth IRA,FDRXX**,FIDELITY GOVERNMENT CASH RESERVES,,,,$40.00,,,,,1.00%,,,Cash,
+X2,Roth IRA,NVDA,NVIDIA CORPORATION COM,20,$125.00,+$1.50,"$2,500.00",+$30.00,+1.21%,+$500.00,+25.00%,62.50%,"$2,000.00",$100.00,Cash,
+X2,Roth IRA,MSFT,MICROSOFT CORP,4,$375.00,-$2.00,"$1,500.00",-$8.00,-0.53%,$100.00,+7.14%,37.50%,"$1,400.00",$350.00,Cash,
+X2,Roth IRA,Pending Activity,,,,,-$20.00,,,,,,,,,
+
+"The data and information in this spreadsheet is provided to you solely for your use and is not for distribution."
+"Date downloaded 06/12/2024 4:36 PM ET"
+"""
+
+def test_load_fidelity_export():
+    positions = nim.PositionLoader.load(io.StringIO(FIDELITY_CSV))
+    assert positions[["Account Number", "Symbol"]].values.tolist() == [["X1", "NVDA"], ["X1", "MSFT"], ["X2", "NVDA"], ["X2", "MSFT"]]
+    # Columns stay in place despite the trailing commas
+    assert positions["Description"].tolist()[:2] == ["NVIDIA CORPORATION COM", "MICROSOFT CORP"]
+    assert positions["Current Value"].tolist() == [1250.0, 750.0, 2500.0, 1500.0]
+    assert positions["Total Gain/Loss Dollar"].tolist() == [250.0, -50.0, 500.0, 100.0]
+    assert positions["Total Gain/Loss Percent"].tolist() == [25.0, -6.25, 25.0, 7.14]
+    assert positions["Average Cost Basis"].tolist() == [100.0, 400.0, 100.0, 350.0]
+    assert positions["Type"].tolist() == ["Cash"] * 4
+    # Money-market core positions and pending activity are cash, not holdings
+    assert positions.attrs["cash_value"] == 520.0
+
+def test_accounts_keep_their_own_cash(tmp_path):
+    import batch
+    path = tmp_path / "Portfolio_Positions.csv"
+    path.write_text(FIDELITY_CSV, encoding="utf-8")
+    accounts = batch.load_accounts(str(path))
+    assert {name: df.attrs["cash_value"] for name, df in accounts.items()} == {"Portfolio_Positions-X1": 500.0, "Portfolio_Positions-X2": 20.0}
+    assert nim.position_weights(accounts["Portfolio_Positions-X1"]) == {"NVDA": 0.5, "MSFT": 0.3}
+    assert nim.position_weights(accounts["Portfolio_Positions-X2"]) == pytest.approx({"NVDA": 2500 / 4020, "MSFT": 1500 / 4020})
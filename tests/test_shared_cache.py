@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pandas as pd
+import pytest
+import nim
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+def counted_fetch(calls_path):
+    with open(calls_path, "a") as f:
+        f.write(f"{os.getpid()}\n")
+    time.sleep(0.5)
+    return {"value": 42}
+
+def fetch_from_threads(args):
+    cache_path, calls_path = args
+    cache = nim.SharedCache(cache_path)
+    with ThreadPoolExecutor(8) as pool:
+        return list(pool.map(lambda _: cache.get_or_fetch("statements", "NVDA", lambda: counted_fetch(calls_path)), range(8)))
+
+def test_single_flight_across_processes_and_threads(tmp_path):
+    cache_path, calls_path = str(tmp_path / "shared.sqlite"), str(tmp_path / "calls")
+    with ProcessPoolExecutor(4) as pool:
+        results = [value for values in pool.map(fetch_from_threads, [(cache_path, calls_path)] * 4) for value in values]
+    assert results == [{"value": 42}] * 32
+    with open(calls_path) as f:
+        assert len(f.read().split()) == 1
+
+def test_failures_are_not_stored(tmp_path):
+    cache = nim.SharedCache(str(tmp_path / "shared.sqlite"))
+
+    def fail():
+        raise RuntimeError("upstream down")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_fetch("news", "NVDA", fail)
+    assert cache.get("news", "NVDA") is None
+    assert cache.get_or_fetch("news", "NVDA", lambda: "headlines") == "headlines"
+
+def test_held_lease_is_renewed(tmp_path):
+    # Two instances stand in for two replicas; the fetch outlives the lock timeout several times over
+    path = str(tmp_path / "shared.sqlite")
+    first, second = nim.SharedCache(path, lock_timeout=0.3), nim.SharedCache(path, lock_timeout=0.3)
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        time.sleep(1.5)
+        return "analysis"
+
+    holder = threading.Thread(target=first.get_or_fetch, args=("analyses", "NVDA", slow_fetch))
+    holder.start()
+    time.sleep(0.2)
+    assert second.get_or_fetch("analyses", "NVDA", slow_fetch) == "analysis"
+    holder.join()
+    assert len(calls) == 1
+
+def test_fetch_errors_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(nim, "shared_cache", nim.SharedCache(str(tmp_path / "shared.sqlite")))
+    outcomes = [RuntimeError("Yahoo down"), pd.DataFrame({"Close": [1.0, 2.0]})]
+
+    class Store:
+        def get(self, symbol, fetch):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+    monkeypatch.setattr(nim, "price_store", Store())
+    data, summary = nim.DataFetcher.get_stock_data("ERRTEST")
+    assert data is None and summary.startswith("Error")
+    data, summary = nim.DataFetcher.get_stock_data("ERRTEST")
+    assert summary == "Symbol: ERRTEST\nPrice: 2.0\n"
+
+def test_empty_statements_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(nim, "shared_cache", nim.SharedCache(str(tmp_path / "shared.sqlite")))
+    statements = [pd.DataFrame(), pd.DataFrame({pd.Timestamp("2024-03-31"): [1.0]}, index=["Total Revenue"])]
+
+    class Ticker:
+        def __init__(self, symbol):
+            self.quarterly_financials = statements.pop(0)
+            self.quarterly_balance_sheet = pd.DataFrame()
+
+    monkeypatch.setattr(nim.yf, "Ticker", Ticker)
+    data, error = nim.DataFetcher.get_financial_statements("EMPTYTEST")
+    assert data is None and error.startswith("Error")
+    assert nim.DataFetcher.get_financial_statements("EMPTYTEST").loc["Total Revenue"].iloc[0] == 1.0
+
+def test_price_store_creates_its_directory_on_first_write(tmp_path):
+    store = nim.PriceStore(str(tmp_path / "prices"))
+    assert not os.path.exists(store.root)
+    store.save("NVDA", pd.DataFrame({"Close": [1.0]}, index=pd.DatetimeIndex(["2024-06-03"])))
+    assert store.load("NVDA")["Close"].iloc[0] == 1.0
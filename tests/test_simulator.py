@@ -0,0 +1,54 @@
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+import nim
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+def reference_run(prices, weights, rebalance_days, stop_loss, cost):
+    # One scenario, one day at a time: the loop Simulator.run replaces
+    growth = prices[1:] / prices[:-1]
+    if stop_loss:
+        growth = np.where(nim.Simulator.stop_mask(prices, stop_loss), growth, 1.0)
+    target = np.append(weights, max(0.0, 1.0 - weights.sum()))
+    holdings = target.copy()
+    equity, turnover = [1.0], 0.0
+    for t in range(len(growth)):
+        if rebalance_days and t > 0 and t % rebalance_days == 0:
+            value = holdings.sum()
+            turn = 0.5 * np.abs(holdings / value - target).sum()
+            turnover += turn
+            holdings = target * value * (1.0 - cost * turn)
+        holdings = holdings * np.append(growth[t], 1.0)
+        equity.append(holdings.sum())
+    return np.array(equity), turnover
+
+@pytest.mark.parametrize("rebalance_days, stop_loss, cost", [(0, 0.0, 0.0), (21, 0.0, 0.001), (63, 0.2, 0.0005), (7, 0.1, 0.01)])
+def test_run_matches_reference_loop(rebalance_days, stop_loss, cost):
+    rng = np.random.default_rng(1)
+    prices = 50 * np.cumprod(1 + rng.normal(0.0005, 0.03, (300, 6)), axis=0)
+    weights = rng.dirichlet(np.ones(6), 7) * rng.uniform(0.6, 1.0, (7, 1))
+    equity, turnover = nim.Simulator.run(prices, weights, rebalance_days, stop_loss, cost)
+    for s in range(len(weights)):
+        expected_equity, expected_turnover = reference_run(prices, weights[s], rebalance_days, stop_loss, cost)
+        assert np.allclose(equity[s], expected_equity)
+        assert np.isclose(turnover[s].sum(), expected_turnover)
+
+def test_position_weights_leave_cash_share_in_cash():
+    positions = pd.DataFrame({"Symbol": ["AAA", "BBB", "AAA"], "Current Value": [300.0, 200.0, 100.0]})
+    positions.attrs["cash_value"] = 400.0
+    assert nim.position_weights(positions) == pytest.approx({"AAA": 0.4, "BBB": 0.2})
+
+def test_simulate_in_blocks_matches_one_batch(monkeypatch):
+    rng = np.random.default_rng(2)
+    dates = pd.bdate_range("2022-01-03", periods=300)
+    closes = pd.DataFrame(50 * np.cumprod(1 + rng.normal(0.0005, 0.03, (300, 6)), axis=0), index=dates, columns=list("ABCDEF"))
+    current = dict(zip(closes.columns, rng.dirichlet(np.ones(6)) * 0.9))
+    scenarios = nim.Simulator.scenarios(list(closes.columns), current, 21, 0.15, {"B": "Sell"}, random_scenarios=25)
+    whole = nim.Simulator.simulate(closes, list(closes.columns), scenarios, 0.001)
+    # Two scenarios per block instead of one batch per setting
+    monkeypatch.setattr(nim, "SIMULATION_MAX_CELLS", 2 * closes.size)
+    blocked = nim.Simulator.simulate(closes, list(closes.columns), scenarios, 0.001)
+    assert np.allclose(blocked["equity"], whole["equity"])
+    pd.testing.assert_frame_equal(blocked["summary"], whole["summary"])